@@ -0,0 +1,95 @@
+"""
+Offline search of many queries, streamed from a file (or stdin) to JSONL results.
+
+Every input line is one query, either a JSON object {"id": ..., "query": ...},
+a TSV line `id<TAB>query` or a bare query (its id is then the line number).
+"""
+import json
+import logging
+import sys
+from contextlib import nullcontext
+from itertools import islice
+
+import numpy as np
+
+from search_engine import BlockedSearchEngine
+
+logger = logging.getLogger(__name__)
+
+
+def read_queries(lines):
+    """yield (id, query) for every non empty line"""
+    for line_no, line in enumerate(lines):
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        if line.lstrip().startswith('{'):
+            record = json.loads(line)
+            yield record.get('id', line_no), record['query']
+        elif '\t' in line:
+            query_id, query = line.split('\t', 1)
+            yield query_id, query
+        else:
+            yield line_no, line
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def batch_search(searcher, model, fin, fout, n_results, with_snippets=False):
+    """
+    search all the queries of `fin`, `conf['batch_query_tile']` queries at a time, writing one JSON
+    line per query to `fout`. Memory only depends on the tile sizes, not on the number of queries.
+    """
+    conf = searcher.model_params
+    metrics = searcher.metrics
+    searcher.load_codevecs()
+    if with_snippets:
+        searcher.load_codebase()
+    if conf['search_index'] == 'exact' and conf['search_processes'] <= 1:
+        # queries x codes tiles small enough to stay in cache
+        engine = BlockedSearchEngine(searcher.codevecs, conf['batch_code_tile'], conf['search_workers'],
+                                     metrics=metrics if metrics.enabled else None)
+        engine.deleted = searcher.deleted
+    else:
+        engine = searcher.search_engine
+    metrics.set('index_size', len(engine))
+
+    n_queries = 0
+    for batch in batches(read_queries(fin), conf['batch_query_tile']):
+        # one padded matrix per batch, unknown words are UNK_token
+        with metrics.time('tokenize_batch'):
+            descs = searcher.tokenizer([query for _, query in batch])
+        with metrics.time('encode_batch'):
+            desc_reprs = searcher.encode_descs(model, descs)
+        with metrics.time('search_batch'):
+            scores, ids = engine.search_batch(desc_reprs, n_results)
+        for (query_id, query), row_scores, row_ids in zip(batch, scores, ids):
+            # approximate engines pad short result lists with -1, deleted rows score -inf
+            keep = (row_ids >= 0) & np.isfinite(row_scores)
+            results = [{'id': int(i), 'score': float(s)} for i, s in zip(row_ids[keep], row_scores[keep])]
+            if with_snippets:
+                for result, snippet in zip(results, searcher.codebase.get(row_ids[keep])):
+                    result['snippet'] = snippet
+            fout.write(json.dumps({'id': query_id, 'query': query, 'results': results}) + '\n')
+            metrics.inc('results', len(results))
+        n_queries += len(batch)
+        metrics.inc('queries', len(batch))
+        logger.info("{} queries searched".format(n_queries))
+
+    if engine is not searcher.search_engine:
+        engine.close()
+    return n_queries
+
+
+def open_or_std(fname, mode):
+    """context manager of the file `fname`, or of stdin/stdout for '-', which are left open"""
+    if fname == '-':
+        return nullcontext(sys.stdin if 'r' in mode else sys.stdout)
+    return open(fname, mode, encoding='utf-8')
@@ -0,0 +1,82 @@
+"""
+Padding-aware vs padded SeqEncoder: encoding speed on short sequences padded to a fixed length,
+and output parity on unpadded input.
+
+    python -m benchmarks.encoder --mean-len 6 --seq-len 30
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from configs import get_config
+from data import PAD_token
+from models import SeqEncoder
+
+
+def random_batch(batch_size, seq_len, mean_len, n_words, rng):
+    """padded batch of sequences with geometric lengths of mean `mean_len`, clipped to [1, seq_len]"""
+    lengths = np.clip(rng.geometric(1.0 / mean_len, batch_size), 1, seq_len)
+    batch = np.full((batch_size, seq_len), PAD_token, dtype=np.int64)
+    for i, length in enumerate(lengths):
+        batch[i, :length] = rng.randint(4, n_words, length)
+    return torch.from_numpy(batch), lengths
+
+
+def time_encoder(encoder, batches, train=False):
+    """mean seconds per batch, forward only or forward + backward"""
+    encoder.train(train)
+    start = time.perf_counter()
+    for batch in batches:
+        if train:
+            encoder.zero_grad()
+            encoder(batch).sum().backward()
+        else:
+            with torch.no_grad():
+                encoder(batch)
+    return (time.perf_counter() - start) / len(batches)
+
+
+def run(conf, batch_size, seq_len, mean_len, n_batches, seed=42):
+    rng = np.random.RandomState(seed)
+    torch.manual_seed(seed)
+    padded = SeqEncoder(conf['n_words'], conf['emb_size'], conf['lstm_dims'], pad_aware=False)
+    packed = SeqEncoder(conf['n_words'], conf['emb_size'], conf['lstm_dims'], pad_aware=True)
+    packed.load_state_dict(padded.state_dict())
+
+    batches, lengths = zip(*[random_batch(batch_size, seq_len, mean_len, conf['n_words'], rng)
+                             for _ in range(n_batches)])
+    report = {'batch_size': batch_size, 'seq_len': seq_len, 'mean_len': float(np.mean(lengths)),
+              'padding': 1.0 - float(np.mean(lengths)) / seq_len}
+    for name, train in (('encode', False), ('train', True)):
+        time_encoder(padded, batches[:1], train)  # warm up
+        report[name + '_padded_ms'] = time_encoder(padded, batches, train) * 1000
+        time_encoder(packed, batches[:1], train)
+        report[name + '_packed_ms'] = time_encoder(packed, batches, train) * 1000
+        report[name + '_speedup'] = report[name + '_padded_ms'] / report[name + '_packed_ms']
+
+    # without padding both encoders must compute the same thing
+    full = torch.from_numpy(rng.randint(4, conf['n_words'], (batch_size, seq_len)).astype(np.int64))
+    padded.eval(), packed.eval()
+    with torch.no_grad():
+        report['parity_max_abs_diff'] = float((padded(full) - packed(full)).abs().max())
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark the padding-aware SeqEncoder")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seq-len", type=int, default=30, help="padded length (api_len/desc_len)")
+    parser.add_argument("--mean-len", type=float, default=6, help="mean real length of the sequences")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    print(json.dumps(run(get_config(), args.batch_size, args.seq_len, args.mean_len, args.batches), indent=2))
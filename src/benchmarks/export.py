@@ -0,0 +1,115 @@
+"""
+Exported (quantized TorchScript) encoders against the float JointEmbeder: cosine drift of the
+representations for several batch sizes, per-query latency of `desc_encoding` and codes/sec of
+`code_encoding`.
+
+    python -m benchmarks.export --epoch 100 --threads 1
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.encoder import random_batch
+from codesearcher import CodeSearcher
+from configs import get_config
+from export import BATCH_SIZES, InferenceModel, export
+from models import JointEmbeder
+
+
+def cosine_drift(a, b):
+    """1 - cos(a_i, b_i) of every row"""
+    a, b = a.data.cpu().numpy(), b.data.cpu().numpy()
+    cos = (a * b).sum(1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-12)
+    return 1.0 - cos
+
+
+def batch_size_drift(model, exported, queries, batches, batch_sizes):
+    """{batch size: max desc and code drift} on the first rows of the queries and code batches"""
+    drift = {}
+    descs = torch.cat(queries)
+    for batch_size in batch_sizes:
+        code = tuple(field[:batch_size] for field in batches[0])
+        drift[str(batch_size)] = float(max(
+            cosine_drift(model.desc_encoding(descs[:batch_size]), exported.desc_encoding(descs[:batch_size])).max(),
+            cosine_drift(model.code_encoding(*code), exported.code_encoding(*code)).max()))
+    return drift
+
+
+def query_latencies(model, queries):
+    """milliseconds of every single query desc_encoding"""
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.eval().desc_encoding(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def codes_per_sec(model, batches):
+    start = time.perf_counter()
+    for names, apis, toks in batches:
+        model.eval().code_encoding(names, apis, toks)
+    return sum(len(names) for names, _, _ in batches) / (time.perf_counter() - start)
+
+
+def run(conf, epoch, n_queries, batch_size, n_batches, quantize, mean_len, seed=42):
+    rng = np.random.RandomState(seed)
+    torch.manual_seed(seed)
+    model = JointEmbeder(conf)
+    if epoch:
+        CodeSearcher(conf).load_model_epoch(model, epoch)
+    model.eval()
+    with tempfile.TemporaryDirectory() as tmp:
+        export(model, os.path.join(tmp, 'model'), conf, quantize)
+        exported = InferenceModel(os.path.join(tmp, 'model'), conf)
+
+    queries = [random_batch(1, conf['desc_len'], mean_len, conf['n_words'], rng)[0] for _ in range(n_queries)]
+    batches = [tuple(random_batch(batch_size, conf[key], mean_len, conf['n_words'], rng)[0]
+                     for key in ('name_len', 'api_len', 'tokens_len')) for _ in range(n_batches)]
+
+    report = {'epoch': epoch, 'quantized': quantize, 'threads': torch.get_num_threads()}
+    with torch.no_grad():
+        descs = torch.cat(queries)
+        desc_drift = cosine_drift(model.desc_encoding(descs), exported.desc_encoding(descs))
+        code_drift = np.concatenate([cosine_drift(model.code_encoding(*batch), exported.code_encoding(*batch))
+                                     for batch in batches])
+        report.update({'desc_drift_mean': float(desc_drift.mean()), 'desc_drift_max': float(desc_drift.max()),
+                       'code_drift_mean': float(code_drift.mean()), 'code_drift_max': float(code_drift.max())})
+        # the graphs are traced with one batch size, they must give the same vectors for all of them
+        batch_sizes = sorted(set(BATCH_SIZES + (min(batch_size, n_queries),)))
+        report['batch_size_drift_max'] = batch_size_drift(model, exported, queries, batches, batch_sizes)
+
+        for name, encoder in (('float', model), ('export', exported)):
+            query_latencies(encoder, queries[:10])  # warm up
+            latencies = query_latencies(encoder, queries)
+            report[name + '_query_ms_p50'] = float(np.percentile(latencies, 50))
+            report[name + '_query_ms_p99'] = float(np.percentile(latencies, 99))
+            report[name + '_codes_per_sec'] = codes_per_sec(encoder, batches)
+    report['query_speedup'] = report['float_query_ms_p50'] / report['export_query_ms_p50']
+    report['codes_speedup'] = report['export_codes_per_sec'] / report['float_codes_per_sec']
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark the exported encoders against the float model")
+    parser.add_argument("--epoch", type=int, default=0, help="weights to load, 0 for random weights")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=5)
+    parser.add_argument("--mean-len", type=float, default=6, help="mean real length of the sequences")
+    parser.add_argument("--no-quantize", action="store_true", help="TorchScript only")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    print(json.dumps(run(get_config(), args.epoch, args.queries, args.batch_size, args.batches,
+                         not args.no_quantize, args.mean_len), indent=2))
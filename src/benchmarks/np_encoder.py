@@ -0,0 +1,86 @@
+"""
+NumPy desc encoder against the torch desc_encoding: output parity, per-query latency and the
+startup time of a fresh process loading it (without importing torch).
+
+    python -m benchmarks.np_encoder --epoch 100
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.encoder import random_batch
+from codesearcher import CodeSearcher
+from configs import get_config
+from models import JointEmbeder
+from np_encoder import NumpyDescEncoder, export_desc_encoder
+
+STARTUP = """
+import sys, time
+start = time.perf_counter()
+from np_encoder import NumpyDescEncoder
+NumpyDescEncoder(sys.argv[1])
+print(time.perf_counter() - start, 'torch' in sys.modules)
+"""
+
+
+def startup_time(fname):
+    """(seconds to import and load the encoder in a new process, whether torch got imported)"""
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', STARTUP, fname], cwd=src_dir)
+    seconds, torch_imported = output.decode().split()
+    return float(seconds), torch_imported == 'True'
+
+
+def run(conf, epoch, n_queries, mean_len, seed=42):
+    rng = np.random.RandomState(seed)
+    torch.manual_seed(seed)
+    model = JointEmbeder(conf)
+    if epoch:
+        CodeSearcher(conf).load_model_epoch(model, epoch)
+    model.eval()
+
+    report = {'epoch': epoch, 'pad_aware': conf['pad_aware']}
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'desc.npz')
+        export_desc_encoder(model, fname)
+        report['npz_bytes'] = os.path.getsize(fname)
+        report['startup_s'], report['startup_imports_torch'] = startup_time(fname)
+        encoder = NumpyDescEncoder(fname)
+
+    queries = [random_batch(1, conf['desc_len'], mean_len, conf['n_words'], rng)[0] for _ in range(n_queries)]
+    descs = torch.cat(queries)
+    with torch.no_grad():
+        expected = model.desc_encoding(descs).numpy()
+        latencies = {'torch': [], 'numpy': []}
+        for query in queries:
+            start = time.perf_counter()
+            model.desc_encoding(query)
+            latencies['torch'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            encoder.desc_encoding(query.numpy())
+            latencies['numpy'].append(time.perf_counter() - start)
+    report['max_abs_diff'] = float(np.abs(encoder.desc_encoding(descs.numpy()) - expected).max())
+    for name, values in latencies.items():
+        report[name + '_query_ms_p50'] = float(np.percentile(values, 50) * 1000)
+        report[name + '_query_ms_p99'] = float(np.percentile(values, 99) * 1000)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Compare the NumPy desc encoder with the torch one")
+    parser.add_argument("--epoch", type=int, default=0, help="weights to load, 0 for random weights")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--mean-len", type=float, default=6, help="mean real length of the queries")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(json.dumps(run(get_config(), args.epoch, args.queries, args.mean_len), indent=2))
@@ -0,0 +1,190 @@
+"""
+Benchmarks of the hot paths on a synthetic dataset (see benchmarks/synthetic.py), written as JSON
+so that the results of two commits can be compared:
+
+    python -m benchmarks.synthetic /tmp/codesearch-bench/ --codevecs 1000000 5000000
+    python -m benchmarks.suite /tmp/codesearch-bench/ --output bench.json --search-sizes 100000 1000000 5000000
+
+dataset: examples/sec of the hdf5 and array backed datasets, train: steps/sec, repr_code: codes/sec,
+eval: seconds per evaluation, search: query latency percentiles and batched queries/sec per index size.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import codevecs_name
+from configs import get_config
+from process_search import ProcessSearchEngine
+from search_engine import BlockedSearchEngine, limit_blas_threads
+from utils import gVar, normalize
+from vecstore import open_store
+
+BENCHMARKS = ('dataset', 'train', 'repr_code', 'eval', 'search')
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_dataset(conf, n_batches):
+    from data import ArrayDataset, CodeSearchDataset, SPLITS, batch_loader
+
+    files = [conf['workdir']]
+    for key, len_key in zip(SPLITS['train'], ('name_len', 'api_len', 'tokens_len', 'desc_len')):
+        files += [conf[key], conf[len_key]]
+    report = {}
+    for name, dataset in (('hdf5', CodeSearchDataset), ('arrays', ArrayDataset)):
+        dataset, seconds = timed(dataset, *files)
+        batches = [np.arange(i, i + conf['batch_size']) for i in range(0, n_batches * conf['batch_size'],
+                                                                        conf['batch_size'])]
+        _, read_seconds = timed(list, batch_loader(dataset, batches))
+        report[name] = {'open_s': seconds, 'examples_per_sec': n_batches * conf['batch_size'] / read_seconds}
+    return report
+
+
+def bench_train(searcher, conf, n_steps):
+    import torch
+    from data import BucketBatchSampler, batch_loader, load_dataset
+
+    model = searcher.load_model('train')
+    optimizer = torch.optim.Adam(model.parameters(), lr=conf['lr'])
+    train_set = load_dataset(conf, 'train', bad_descs=conf['negatives'] == 'random')
+    if searcher.bucketing():
+        sampler = BucketBatchSampler(train_set.lengths(), conf['batch_size'], drop_last=True,
+                                     window=conf['bucket_window'])
+    else:
+        sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(train_set), conf['batch_size'], True)
+    steps, start = 0, None
+    for batch in batch_loader(train_set, sampler, trim=searcher.bucketing()):
+        if steps == 1:  # the first step pays the allocations
+            start = time.perf_counter()
+        loss = model.train()(*[gVar(field) for field in batch])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        steps += 1
+        if steps > n_steps:
+            break
+    assert steps > 1, 'Not enough training data for {} steps'.format(n_steps)
+    return {'steps': steps - 1, 'steps_per_sec': (steps - 1) / (time.perf_counter() - start),
+            'batch_size': conf['batch_size'], 'negatives': conf['negatives'], 'bucketing': searcher.bucketing()}
+
+
+def bench_repr_code(conf):
+    from codesearcher import CodeSearcher
+
+    # written next to the synthetic vectors, which the search benchmark keeps using
+    conf = dict(conf, use_codevecs='benchmark.' + conf['use_codevecs'])
+    searcher = CodeSearcher(conf)
+    model = searcher.load_model('repr_code')
+    vecs, seconds = timed(searcher.repr_code, model)
+    n_codes = len(vecs)
+    del vecs
+    os.remove(conf['workdir'] + conf['use_codevecs'])
+    return {'codes': n_codes, 'codes_per_sec': n_codes / seconds, 'streaming': conf['repr_streaming']}
+
+
+def bench_eval(searcher, conf, poolsize):
+    model = searcher.load_model('eval')
+    (acc, mrr, map_, ndcg), seconds = timed(searcher.eval, model, poolsize, 10)
+    return {'poolsize': poolsize, 'seconds': seconds, 'mrr': mrr}
+
+
+def bench_search(conf, sizes, n_queries, batch_size, n_results=10, seed=42):
+    """
+    exact search latency on the vector stores written by `synthetic.py --codevecs`, with the threads
+    of BlockedSearchEngine, or the worker processes of ProcessSearchEngine if conf['search_processes'] > 1
+    """
+    rng = np.random.RandomState(seed)
+    report = {}
+    limit_blas_threads(conf['blas_threads'])
+    for size in sizes:
+        fname = conf['workdir'] + (codevecs_name(size) if size else conf['use_codevecs'])
+        if not os.path.exists(fname):
+            report[str(size)] = {'error': '{} not found, generate it with --codevecs'.format(fname)}
+            continue
+        vecs = open_store(fname)
+        if conf['search_processes'] > 1:
+            engine = ProcessSearchEngine(vecs, fname, conf['search_processes'], conf['chunk_size'],
+                                         conf['blas_threads'])
+        else:
+            engine = BlockedSearchEngine(vecs, conf['chunk_size'], conf['search_workers'])
+        queries = normalize(rng.standard_normal((n_queries, vecs.shape[1])).astype(np.float32))
+        engine.search(queries[0], n_results)  # warm up the page cache
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            engine.search(query, n_results)
+            latencies.append((time.perf_counter() - start) * 1000)
+        _, seconds = timed(engine.search_batch, queries[:batch_size], n_results)
+        report[str(len(vecs))] = {'p50_ms': float(np.percentile(latencies, 50)),
+                                  'p90_ms': float(np.percentile(latencies, 90)),
+                                  'p99_ms': float(np.percentile(latencies, 99)),
+                                  'batch_queries_per_sec': min(batch_size, n_queries) / seconds,
+                                  'processes': conf['search_processes']}
+        engine.close()
+        del vecs
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(conf, benchmarks, args):
+    from codesearcher import CodeSearcher
+
+    searcher = CodeSearcher(conf)
+    results = {}
+    if 'dataset' in benchmarks:
+        results['dataset'] = bench_dataset(conf, args.batches)
+    if 'train' in benchmarks:
+        results['train'] = bench_train(searcher, conf, args.steps)
+    if 'repr_code' in benchmarks:
+        results['repr_code'] = bench_repr_code(conf)
+    if 'eval' in benchmarks:
+        results['eval'] = bench_eval(searcher, conf, args.poolsize)
+    if 'search' in benchmarks:
+        results['search'] = bench_search(conf, args.search_sizes, args.queries, args.batch_queries)
+    return {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': platform.platform(),
+            'cpus': os.cpu_count(), 'results': results}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark the hot paths on a synthetic dataset")
+    parser.add_argument("workdir", help="synthetic dataset written by benchmarks.synthetic")
+    parser.add_argument("--only", nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--output", default='-', help="JSON results file, - for stdout")
+    parser.add_argument("--batches", type=int, default=200, help="batches read by the dataset benchmark")
+    parser.add_argument("--steps", type=int, default=50, help="training steps")
+    parser.add_argument("--poolsize", type=int, default=1000, help="eval pool size")
+    parser.add_argument("--search-sizes", type=int, nargs='+', default=[0],
+                        help="vector store sizes, 0 for the use_codevecs store")
+    parser.add_argument("--queries", type=int, default=200, help="single queries timed per index size")
+    parser.add_argument("--batch-queries", type=int, default=64, help="queries of the batched search")
+    parser.add_argument("--search-processes", type=int, default=0,
+                        help="> 1: search with that many worker processes instead of threads")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    conf = get_config()
+    conf['workdir'] = os.path.join(args.workdir, '')
+    conf['search_processes'] = args.search_processes
+    report = run(conf, args.only, args)
+    if args.output == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
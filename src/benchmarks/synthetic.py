@@ -0,0 +1,114 @@
+"""
+Synthetic dataset in the layout of `configs.get_config`, at any scale: phrases/indices HDF5 files of
+the train, test and use splits, vocabulary pickles, the raw codebase and code vector stores.
+
+    python -m benchmarks.synthetic /tmp/codesearch-bench/ --train 100000 --valid 10000 --use 100000
+    python -m benchmarks.synthetic /tmp/codesearch-bench/ --codevecs 1000000 5000000
+
+Sequence lengths follow a geometric distribution around `mean_len`; word ids are drawn from a Zipf law,
+so the vocabulary and cache behaviour look like real queries.
+"""
+import argparse
+import os
+import pickle
+
+import numpy as np
+import tables
+
+from configs import get_config
+from utils import normalize
+from vecstore import append_vecs, create_store
+from vocab import UNK_token
+
+# split -> config keys of its (method name, API sequence, tokens, description) files
+SPLIT_FILES = {
+    'train': ('train_name', 'train_api', 'train_tokens', 'train_desc'),
+    'valid': ('valid_name', 'valid_api', 'valid_tokens', 'valid_desc'),
+    'use': ('use_names', 'use_apis', 'use_tokens', None),
+}
+MEAN_LENS = {'name_len': 3, 'api_len': 8, 'tokens_len': 10, 'desc_len': 8}
+CHUNK_ROWS = 65536
+
+
+def codevecs_name(n_rows):
+    return 'synthetic.codevecs.{}.vecs'.format(n_rows)
+
+
+def random_words(n, n_words, rng):
+    """word ids in [UNK_token + 1, n_words), Zipf distributed"""
+    return (UNK_token + (rng.zipf(1.3, n) - 1) % (n_words - UNK_token - 1) + 1).astype(np.int32)
+
+
+def write_phrases(fname, n_rows, maxlen, mean_len, n_words, rng):
+    """phrases/indices hdf5 file of n_rows sequences"""
+    with tables.open_file(fname, 'w') as h5f:
+        phrases = h5f.create_earray('/', 'phrases', tables.Int32Atom(), (0,))
+        indices = h5f.create_table('/', 'indices', {'length': tables.UInt32Col(pos=0), 'pos': tables.UInt64Col(pos=1)})
+        pos = 0
+        for start in range(0, n_rows, CHUNK_ROWS):
+            # a few sequences are longer than maxlen, the datasets truncate them
+            lengths = np.minimum(rng.geometric(1.0 / mean_len, min(CHUNK_ROWS, n_rows - start)), maxlen + 5)
+            phrases.append(random_words(int(lengths.sum()), n_words, rng))
+            rows = np.empty(len(lengths), dtype=[('length', np.uint32), ('pos', np.uint64)])
+            rows['length'] = lengths
+            rows['pos'] = pos + np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            indices.append(rows)
+            pos += int(lengths.sum())
+
+
+def write_vocab(fname, n_words):
+    vocab = {'<pad>': 0, '<s>': 1, '</s>': 2, '<unk>': UNK_token}
+    vocab.update(('w{}'.format(i), i) for i in range(UNK_token + 1, n_words))
+    with open(fname, 'wb') as f:
+        pickle.dump(vocab, f)
+
+
+def write_codebase(fname, n_rows):
+    with open(fname, 'w', encoding='utf-8') as f:
+        for start in range(0, n_rows, CHUNK_ROWS):
+            f.writelines('public int method{0}(int x) {{ return x + {0}; }}\n'.format(i)
+                         for i in range(start, min(start + CHUNK_ROWS, n_rows)))
+
+
+def write_codevecs(fname, n_rows, dim, dtype, rng):
+    """normalized random vectors, written block by block"""
+    create_store(fname, dim, dtype, True)
+    for start in range(0, n_rows, CHUNK_ROWS):
+        append_vecs(fname, normalize(rng.standard_normal((min(CHUNK_ROWS, n_rows - start), dim)).astype(np.float32)))
+
+
+def generate(workdir, conf, n_train, n_valid, n_use, codevecs=(), seed=42):
+    """
+    write the synthetic dataset to `workdir`, the file names are the ones of `conf`.
+    codevecs: sizes of the extra vector stores written for the search benchmarks (see codevecs_name)
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(workdir, exist_ok=True)
+    for split, n_rows in (('train', n_train), ('valid', n_valid), ('use', n_use)):
+        for key, len_key in zip(SPLIT_FILES[split], ('name_len', 'api_len', 'tokens_len', 'desc_len')):
+            if key is not None:
+                write_phrases(workdir + conf[key], n_rows, conf[len_key], MEAN_LENS[len_key], conf['n_words'], rng)
+    for key in ('vocab_name', 'vocab_api', 'vocab_tokens', 'vocab_desc'):
+        write_vocab(workdir + conf[key], conf['n_words'])
+    write_codebase(workdir + conf['use_codebase'], n_use)
+    write_codevecs(workdir + conf['use_codevecs'], n_use, conf['n_hidden'], conf['codevecs_dtype'], rng)
+    for n_rows in codevecs:
+        write_codevecs(workdir + codevecs_name(n_rows), n_rows, conf['n_hidden'], conf['codevecs_dtype'], rng)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Generate a synthetic code search dataset")
+    parser.add_argument("workdir", help="output directory, used as conf['workdir'] by the benchmarks")
+    parser.add_argument("--train", type=int, default=100000, help="training examples")
+    parser.add_argument("--valid", type=int, default=10000, help="test examples")
+    parser.add_argument("--use", type=int, default=100000, help="snippets of the use split")
+    parser.add_argument("--codevecs", type=int, nargs='*', default=[], help="sizes of extra vector stores")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    _workdir = os.path.join(args.workdir, '')
+    generate(_workdir, get_config(), args.train, args.valid, args.use, args.codevecs, args.seed)
+    print("Synthetic dataset written to {}".format(_workdir))
@@ -1,23 +1,42 @@
 import argparse
 import logging
-import math
 import os
 import random
 import threading
+from queue import Queue
 
 import numpy as np
-import torch
-import torch.nn.functional as F
-from torch import optim
-from tqdm import tqdm
 
+from cache import LRUCache
 from configs import get_config
-from data import load_dict, CodeSearchDataset, load_vecs, save_vecs
-from models import JointEmbeder
-from utils import normalize, dot_np, gVar, sent2indexes
+from ivf import IVFIndex, IVFSearchEngine, IVF_SUFFIX
+from quantize import QUANTIZERS, QUANTIZED_SUFFIX, QuantizedSearchEngine, load_quantized, save_quantized
+from metrics import Metrics, MetricsExporter
+from search_engine import BlockedSearchEngine, limit_blas_threads
+from snippets import SnippetStore, INDEX_SUFFIX
+from utils import normalize, gVar, pad_batch, pool_ranks, ranking_metrics
+from vecstore import META_SUFFIX, append_vecs, create_store, read_header, read_meta, is_vecstore, load_vecs, \
+    save_vecs, write_meta, write_store
+from vocab import Tokenizer, load_vocab
+
+# torch, the datasets and the model are imported by the roles that need them, a search replica
+# with the NumPy desc encoder never imports torch
+
+DELETED_SUFFIX = '.deleted.npy'
+# attribute -> config key of the vocabularies, loaded on first use
+VOCABS = {'vocab_methname': 'vocab_name', 'vocab_apiseq': 'vocab_api', 'vocab_tokens': 'vocab_tokens',
+          'vocab_desc': 'vocab_desc'}
+# model parts built and loaded by every role
+ROLES = {
+    'train': ('code', 'desc'),
+    'eval': ('code', 'desc'),
+    'repr_code': ('code',),
+    'search': ('desc',),
+}
+MODE_ROLES = {'train': 'train', 'eval': 'eval', 'export': 'eval', 'repr_code': 'repr_code', 'reindex': 'repr_code',
+              'search': 'search', 'serve': 'search', 'batch_search': 'search'}
 
 random.seed(42)
-torch.manual_seed(42)
 np.random.seed(42)
 
 logger = logging.getLogger(__name__)
@@ -36,266 +55,704 @@ class CodeSearcher:
         self.model_params = conf
         self.path = conf['workdir']
 
-        self.vocab_methname = load_dict(self.path + conf['vocab_name'])
-        self.vocab_apiseq = load_dict(self.path + conf['vocab_api'])
-        self.vocab_tokens = load_dict(self.path + conf['vocab_tokens'])
-        self.vocab_desc = load_dict(self.path + conf['vocab_desc'])
-
-        self.codevecs = []
-        self.codebase = []
+        self.codevecs = None
+        self.codebase = None
         self.codebase_chunksize = conf['chunk_size']
+        self.search_engine = None
+        # tombstones of the deleted snippets, skipped by the search until the next compaction
+        self.deleted = None
+        self.index_version = 0  # bumped by every insert, delete and compaction
+        self.index_lock = threading.RLock()
+        self.unsaved_rows = 0  # rows added online missing from the saved approximate index
+        self.compaction = None
+
+        # query tokens -> normalized desc vector, (tokens, n_results, nprobe, version) -> (scores, ids)
+        self.desc_cache = LRUCache(conf['desc_cache_size'])
+        self.result_cache = LRUCache(conf['result_cache_size'])
+        self.cache_fingerprint = None
+        self.model_epoch = None
+        # stage latencies and counters of the search, a disabled registry costs nothing
+        self.metrics = Metrics(conf['metrics'])
 
         self.validation_set = None
 
+    def __getattr__(self, name):
+        # the vocabularies and the query tokenizer are only loaded by the roles that use them
+        if name == 'tokenizer':
+            value = Tokenizer(self.vocab_desc, self.model_params['desc_len'], self.model_params['token_cache_size'])
+        elif name in VOCABS:
+            value = load_vocab(self.path + self.model_params[VOCABS[name]])
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
     # Data Set
     def load_codebase(self):
         """load codebase
         codefile: file that stores raw code
         """
-        logger.info('Loading codebase (chunk size={})'.format(self.codebase_chunksize))
-        if not self.codebase:  # empty
-            # TODO: there are some weird encoding issues so just ignore them for now
-            with open(self.path + self.model_params['use_codebase'], errors='ignore') as f:
-                codes = f.readlines()
-                logging.debug("Loading codebase: {} groups".format(len(codes) // self.codebase_chunksize))
-                for i in range(0, len(codes), self.codebase_chunksize):
-                    logging.debug(
-                        "loading [{}/{}]".format(i // self.codebase_chunksize, len(codes) // self.codebase_chunksize))
-                    self.codebase.append(codes[i:i + self.codebase_chunksize])
+        logger.info('Loading codebase')
+        if self.codebase is None:
+            # row i of the snippet store is row i of the code vectors
+            self.codebase = SnippetStore(self.path + self.model_params['use_codebase'])
+            logging.debug("Loading codebase: {} snippets".format(len(self.codebase)))
 
     # Results Data
     def load_codevecs(self):
-        """read vectors (2D numpy array) from a hdf5 file"""
+        """map the code vectors (2D numpy array) of the vector store"""
         logger.debug('Loading code vectors..')
-        if not self.codevecs:  # empty
-            reprs = load_vecs(self.path + self.model_params['use_codevecs'])
-            logging.debug("Loading codevecs: {} groups".format(len(reprs) // self.codebase_chunksize))
-            for i in range(0, reprs.shape[0], self.codebase_chunksize):
-                logging.debug("loading [{}/{}]".format(i, len(reprs) // self.codebase_chunksize))
-                self.codevecs.append(reprs[i:i + self.codebase_chunksize])
+        if self.codevecs is None:
+            self.convert_legacy_codevecs()
+            # memory mapped matrix, scored block by block by the search engine
+            self.codevecs = load_vecs(self.path + self.model_params['use_codevecs'])
+            logging.debug("Loading codevecs: {} vectors".format(len(self.codevecs)))
+            if self.model_params['search_index'] == 'ivf':
+                # approximate search, the index is built offline with `python ivf.py build`
+                index = IVFIndex.load(self.path + self.model_params['use_codevecs'] + IVF_SUFFIX)
+                logging.debug("Loading IVF index: {} lists".format(index.nlist))
+                # the rows added online since the last save are indexed again
+                self.search_engine = IVFSearchEngine(self.codevecs[:len(index.list_ids)], index,
+                                                     self.model_params['nprobe'])
+            elif self.model_params['search_index'] in QUANTIZERS:
+                # compressed codes in memory, full precision vectors only read for re-ranking
+                quantizer, codes = load_quantized(self.path + self.model_params['use_codevecs'] +
+                                                  QUANTIZED_SUFFIX.format(self.model_params['search_index']))
+                logging.debug("Loading quantized codes: {}".format(codes.shape))
+                self.search_engine = QuantizedSearchEngine(self.codevecs[:len(codes)], quantizer, codes,
+                                                           self.model_params['rerank'])
+            elif self.model_params['search_processes'] > 1:
+                from process_search import ProcessSearchEngine
+
+                # the workers map the store themselves, the vectors are shared through the page cache
+                self.search_engine = ProcessSearchEngine(self.codevecs, self.path + self.model_params['use_codevecs'],
+                                                         self.model_params['search_processes'],
+                                                         self.codebase_chunksize, self.model_params['blas_threads'],
+                                                         metrics=self.metrics if self.metrics.enabled else None)
+            else:
+                self.search_engine = BlockedSearchEngine(self.codevecs, self.codebase_chunksize,
+                                                         n_workers=self.model_params['search_workers'],
+                                                         metrics=self.metrics if self.metrics.enabled else None)
+            if len(self.search_engine) < len(self.codevecs):
+                logger.info("Indexing the {} rows missing from the saved index".format(
+                    len(self.codevecs) - len(self.search_engine)))
+                self.search_engine.append(self.codevecs)
+            self.load_tombstones()
+
+    def convert_legacy_codevecs(self):
+        """
+        workdirs written before the vector store hold `use_codevecs` with an .h5 extension (HDF5):
+        convert it once when the store itself is missing
+        """
+        fname = self.path + self.model_params['use_codevecs']
+        legacy = os.path.splitext(fname)[0] + '.h5'
+        if not os.path.exists(fname) and os.path.exists(legacy):
+            logger.warning("{} not found, converting the legacy {} to a vector store".format(fname, legacy))
+            write_store(load_vecs(legacy), fname, self.model_params['codevecs_dtype'])
+
+    def load_tombstones(self):
+        fname = self.path + self.model_params['use_codevecs'] + DELETED_SUFFIX
+        self.deleted = np.zeros(len(self.codevecs), dtype=bool)
+        if os.path.exists(fname) and os.path.getmtime(fname) >= os.path.getmtime(
+                self.path + self.model_params['use_codevecs']):
+            deleted = np.load(fname)
+            if len(deleted) == len(self.codevecs):
+                self.deleted = deleted
+            else:
+                logger.warning("Ignoring the tombstones of another version of the code vectors")
+        self.search_engine.deleted = self.deleted
+        logging.debug("Loading tombstones: {} deleted".format(int(self.deleted.sum())))
+
+    def save_tombstones(self):
+        np.save(self.path + self.model_params['use_codevecs'] + DELETED_SUFFIX, self.deleted)
+
+    def save_search_index(self):
+        """
+        persist the approximate index next to the code vectors. Rewriting it is O(N): it is saved by the
+        compactions, every conf['index_save_rows'] added rows and by `flush_index`
+        """
+        fname = self.path + self.model_params['use_codevecs']
+        if isinstance(self.search_engine, IVFSearchEngine):
+            self.search_engine.index.save(fname + IVF_SUFFIX)
+        elif isinstance(self.search_engine, QuantizedSearchEngine):
+            save_quantized(fname + QUANTIZED_SUFFIX.format(self.search_engine.quantizer.name),
+                           self.search_engine.quantizer, self.search_engine.codes)
+        self.unsaved_rows = 0
+
+    def flush_index(self):
+        """save the approximate index if rows were added since its last save, on shutdown"""
+        with self.index_lock:
+            if self.unsaved_rows:
+                self.save_search_index()
+
+    # Online updates
+    def add_snippets(self, model, names, apis, tokens, codes):
+        """
+        encode and append snippets to the live index while searches keep running.
+        names, apis, tokens: lists of word indices sequences (as in the use_* files), codes: raw code lines
+        return: the row ids of the new snippets
+        """
+        names = gVar(pad_batch(names, self.model_params['name_len'], fixed=True))
+        apis = gVar(pad_batch(apis, self.model_params['api_len'], fixed=True))
+        tokens = gVar(pad_batch(tokens, self.model_params['tokens_len'], fixed=True))
+        reprs = model.eval().code_encoding(names, apis, tokens).data.cpu().numpy()
+
+        fname = self.path + self.model_params['use_codevecs']
+        if not is_vecstore(fname):
+            raise ValueError('Online updates need a vector store, convert {} with vecstore.py'.format(fname))
+        with self.index_lock:
+            header = read_header(fname)
+            if header.count != len(self.codebase):
+                raise RuntimeError("{} code vectors for {} snippets, the stores are not aligned".format(
+                    header.count, len(self.codebase)))
+            if header.normalized:
+                reprs = normalize(reprs)
+            # the snippets go first, a search must never return a row without its snippet
+            ids = self.codebase.append(codes)
+            try:
+                append_vecs(fname, reprs)
+            except Exception:
+                self.codebase.truncate(ids[0] if len(ids) else len(self.codebase))
+                raise
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(ids), dtype=bool)])
+            self.save_tombstones()
+            self.codevecs = load_vecs(fname)
+            self.search_engine.deleted = self.deleted
+            self.search_engine.append(self.codevecs)
+            self.unsaved_rows += len(ids)
+            if self.unsaved_rows >= self.model_params['index_save_rows']:
+                self.save_search_index()
+            self.index_version += 1
+        return ids
+
+    def delete_snippets(self, ids):
+        """tombstone the given rows, they are removed from the stores by the next compaction"""
+        with self.index_lock:
+            self.deleted[ids] = True
+            self.search_engine.deleted = self.deleted  # the process engine caches the deleted ids
+            self.save_tombstones()
+            self.index_version += 1
+        self.maybe_compact()
+
+    def maybe_compact(self):
+        """start a background compaction once the deleted fraction passes conf['compact_threshold']"""
+        if len(self.deleted) and self.deleted.mean() > self.model_params['compact_threshold'] and \
+                (self.compaction is None or not self.compaction.is_alive()):
+            self.compaction = threading.Thread(target=self.compact)
+            self.compaction.start()
+
+    def compact(self, block_size=65536):
+        """
+        rewrite the vector and snippet stores without the deleted rows and swap them in.
+        The surviving rows are renumbered in order.
+        """
+        vecs_file = self.path + self.model_params['use_codevecs']
+        code_file = self.path + self.model_params['use_codebase']
+        with self.index_lock:
+            vecs, codebase = self.codevecs, self.codebase
+            n_rows = len(vecs)
+            keep = ~self.deleted[:n_rows]
+        rows = np.flatnonzero(keep)
+        logger.info("Compacting the index: {} rows out of {} kept".format(len(rows), n_rows))
+
+        # the heavy rewrite runs without the lock, searches and inserts go on
+        header = read_header(vecs_file)
+        create_store(vecs_file + '.compact', header.dim, header.dtype, header.normalized)
+        for start in range(0, len(rows), block_size):
+            append_vecs(vecs_file + '.compact', vecs[rows[start:start + block_size]])
+        codebase.copy_rows(rows, code_file + '.compact')
+
+        with self.index_lock:
+            # rows inserted during the rewrite are kept as they are
+            vecs, codebase = self.codevecs, self.codebase
+            if len(vecs) > n_rows:
+                append_vecs(vecs_file + '.compact', vecs[n_rows:])
+                codebase.copy_rows(range(n_rows, len(vecs)), code_file + '.compact', mode='ab')
+            keep = np.concatenate([keep, np.ones(len(vecs) - n_rows, dtype=bool)])
+            deleted = self.deleted[keep]
+
+            os.replace(vecs_file + '.compact', vecs_file)
+            os.replace(code_file + '.compact', code_file)
+            if os.path.exists(code_file + INDEX_SUFFIX):
+                os.remove(code_file + INDEX_SUFFIX)
+            self.codevecs = load_vecs(vecs_file)
+            self.codebase = SnippetStore(code_file)
+            self.deleted = deleted
+            self.save_tombstones()
+            search_engine = self.search_engine.compact(self.codevecs, keep)
+            search_engine.deleted = self.deleted
+            self.search_engine = search_engine
+            self.save_search_index()
+            self.index_version += 1
+        logger.info("Compaction done: {} rows".format(len(self.codevecs)))
 
     # Model Loading / saving
+    def load_model(self, role, epoch=0):
+        """JointEmbeder with the parts of `role` only, weights of `epoch` (0: freshly initialized)"""
+        import torch
+        from models import JointEmbeder
+
+        torch.manual_seed(42)
+        model = JointEmbeder(self.model_params, parts=ROLES[role])
+        if epoch > 0:
+            self.load_model_epoch(model, epoch)
+        return model.cuda() if torch.cuda.is_available() else model
+
     def save_model_epoch(self, model, epoch):
+        import torch
+
         if not os.path.exists('{}models/{}/'.format(self.path, self.model_params['model_name'])):
             os.makedirs('{}models/{}/'.format(self.path, self.model_params['model_name']))
         torch.save(model.state_dict(),
                    '{}models/{}/epo{}_code.h5'.format(self.path, self.model_params['model_name'], epoch))
 
     def load_model_epoch(self, model, epoch):
+        """
+        load the weights of the parts of `model`. The checkpoint is a single pickle that cannot be read
+        partially: it is loaded on the CPU and the tensors of the other parts are dropped right away.
+        """
+        import torch
+
         assert os.path.exists('{}models/{}/epo{}_code.h5'.format(self.path, self.model_params['model_name'],
                                                                  epoch)), 'Weights at epoch {} not found'.format(epoch)
-        model.load_state_dict(
-            torch.load('{}models/{}/epo{}_code.h5'.format(self.path, self.model_params['model_name'], epoch)))
+        state = torch.load('{}models/{}/epo{}_code.h5'.format(self.path, self.model_params['model_name'], epoch),
+                           map_location=lambda storage, loc: storage)
+        keys = set(model.state_dict())
+        model.load_state_dict({key: value for key, value in state.items() if key in keys})
+        del state
+        self.model_epoch = epoch
+
+    def export_prefix(self, epoch):
+        return '{}models/{}/epo{}_export'.format(self.path, self.model_params['model_name'], epoch)
+
+    def load_numpy_encoder(self, epoch):
+        """torch-free desc encoder exported (see np_encoder.py) from the weights at `epoch`"""
+        from np_encoder import NumpyDescEncoder, NPZ_SUFFIX
+
+        fname = self.export_prefix(epoch) + NPZ_SUFFIX
+        assert os.path.exists(fname), 'NumPy desc encoder at epoch {} not found'.format(epoch)
+        self.model_epoch = epoch
+        return NumpyDescEncoder(fname)
+
+    def load_export(self, epoch):
+        """
+        inference model exported (see export.py) from the weights at `epoch`,
+        None when the installed torch cannot load it (torch < 1.3)
+        """
+        from export import InferenceModel, DESC_SUFFIX, check_support
+
+        try:
+            check_support(False)
+        except RuntimeError as e:
+            logger.warning("{}: encoding with the eager model instead of the export".format(e))
+            return None
+        assert os.path.exists(self.export_prefix(epoch) + DESC_SUFFIX), 'Export at epoch {} not found'.format(epoch)
+        model = InferenceModel(self.export_prefix(epoch), self.model_params)
+        self.model_epoch = epoch
+        return model
+
+    def profiler(self, name):
+        """PipelineProfiler of the `name` loop when conf['profile'] is on, else a no-op one"""
+        from profiler import NULL_PROFILER, PipelineProfiler
+
+        if not self.model_params['profile']:
+            return NULL_PROFILER
+        profile_dir = self.path + self.model_params['profile_dir']
+        os.makedirs(profile_dir, exist_ok=True)
+        return PipelineProfiler(name, profile_dir + name + '.trace.jsonl', self.model_params['profile_every'],
+                                self.model_params['torch_profile'])
 
     # Training
-    def train(self, model):
+    def train(self, model, optimizer):
+        import torch
+        from data import BucketBatchSampler, batch_loader, load_dataset
+
         log_every = self.model_params['log_every']
         save_every = self.model_params['save_every']
         batch_size = self.model_params['batch_size']
         nb_epoch = self.model_params['nb_epoch']
 
-        train_set = CodeSearchDataset(self.path,
-                                      self.model_params['train_name'], self.model_params['name_len'],
-                                      self.model_params['train_api'], self.model_params['api_len'],
-                                      self.model_params['train_tokens'], self.model_params['tokens_len'],
-                                      self.model_params['train_desc'], self.model_params['desc_len'],
-                                      load_in_memory=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset=train_set, batch_size=batch_size,
-                                                  shuffle=True, drop_last=True, num_workers=4, pin_memory=True)
-
-        for epoch in range(self.model_params['reload'] + 1, nb_epoch):
-            epoch_loss = []
-            losses = []
-            for itr, (names, apis, toks, good_descs, bad_descs) in enumerate(data_loader, start=1):
-                names, apis, toks, good_descs, bad_descs = gVar(names), gVar(apis), gVar(toks), gVar(good_descs), gVar(
-                    bad_descs)
-                loss = model.train()(names, apis, toks, good_descs, bad_descs)
-                losses.append(loss.item())
-                epoch_loss.append(loss.item())
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                if itr % log_every == 0:
-                    logger.info('epo:[{}/{}] itr:{} Loss={:.5f}'.format(epoch, nb_epoch, itr, np.mean(losses)))
-                    losses = []
-
-            if epoch and epoch % save_every == 0:
-                self.save_model_epoch(model, epoch)
-
-            logger.info('[SUMMARY] epo:[{}/{}] Loss={:.5f}'.format(epoch, nb_epoch, np.mean(epoch_loss)))
+        # in-batch negatives need neither the random bad descs nor their encoding
+        train_set = load_dataset(self.model_params, 'train', load_in_memory=True,
+                                 bad_descs=self.model_params['negatives'] == 'random')
+
+        if self.bucketing():
+            sampler = BucketBatchSampler(train_set.lengths(), batch_size, shuffle=True, drop_last=True,
+                                         window=self.model_params['bucket_window'])
+        else:
+            sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(train_set), batch_size,
+                                                    drop_last=True)
+        data_loader = batch_loader(train_set, sampler, trim=self.bucketing(), num_workers=4, pin_memory=True)
+
+        profiler = self.profiler('train')
+        try:
+            for epoch in range(self.model_params['reload'] + 1, nb_epoch):
+                epoch_loss = []
+                losses = []
+                for itr, batch in enumerate(profiler.iterate(data_loader), start=1):
+                    with profiler.stage('transfer'):
+                        batch = [gVar(field) for field in batch]
+                    with profiler.stage('forward'):
+                        # names, apis, toks, good_descs[, bad_descs]
+                        loss = model.train()(*batch)
+                    losses.append(loss.item())
+                    epoch_loss.append(loss.item())
+                    with profiler.stage('backward'):
+                        optimizer.zero_grad()
+                        loss.backward()
+                    with profiler.stage('step'):
+                        optimizer.step()
+                    profiler.step(len(batch[0]))
+                    if itr % log_every == 0:
+                        logger.info('epo:[{}/{}] itr:{} Loss={:.5f}'.format(epoch, nb_epoch, itr, np.mean(losses)))
+                        losses = []
+
+                if epoch and epoch % save_every == 0:
+                    self.save_model_epoch(model, epoch)
+
+                logger.info('[SUMMARY] epo:[{}/{}] Loss={:.5f}'.format(epoch, nb_epoch, np.mean(epoch_loss)))
+        finally:
+            profiler.close()
 
     # Evaluation
     def eval(self, model, poolsize, K, test_all=True):
         """
         simple validation in a code pool.
+        Every desc of a pool is ranked against all the codes of the pool, its own code is the only relevant one.
         @param: poolsize - size of the code pool, if -1, load the whole test set
         """
-
-        def ACC(real, predict):
-            _sum = 0.0
-            for val in real:
-                if val in predict:
-                    _sum += 1
-            return _sum / float(len(real))
-
-        def MAP(real, predict):
-            _sum = 0.0
-            for _id, val in enumerate(real, start=1):
-                try:
-                    index = predict.index(val) + 1
-                except ValueError:
-                    continue
-                else:
-                    _sum += _id / float(index)
-            return _sum / float(len(real))
-
-        def MRR(real, predict):
-            _sum = 0.0
-            for val in real:
-                try:
-                    index = predict.index(val) + 1
-                except ValueError:
-                    continue
-                else:
-                    _sum += 1.0 / float(index)
-            return _sum / float(len(real))
-
-        def NDCG(real, predict):
-            dcg = 0.0
-            idcg = IDCG(len(real))
-            for i, predictItem in enumerate(predict):
-                if predictItem in real:
-                    itemRelevance = 1
-                    rank = i + 1
-                    dcg += (math.pow(2, itemRelevance) - 1.0) * (math.log(2) / math.log(rank + 1))
-            return dcg / float(idcg)
-
-        def IDCG(n):
-            idcg = 0
-            itemRelevance = 1
-            for i in range(n):
-                idcg += (math.pow(2, itemRelevance) - 1.0) * (math.log(2) / math.log(i + 2))
-            return idcg
+        import torch
+        from tqdm import tqdm
+        from data import batch_loader, load_dataset
 
         # load test dataset
         if self.validation_set is None:
-            self.validation_set = CodeSearchDataset(self.path,
-                                                    self.model_params['valid_name'], self.model_params['name_len'],
-                                                    self.model_params['valid_api'], self.model_params['api_len'],
-                                                    self.model_params['valid_tokens'], self.model_params['tokens_len'],
-                                                    self.model_params['valid_desc'], self.model_params['desc_len'],
-                                                    load_in_memory=True)
-
-        data_loader = torch.utils.data.DataLoader(dataset=self.validation_set, batch_size=poolsize,
-                                                  shuffle=False, drop_last=True, num_workers=1, pin_memory=True)
-
-        accs, mrrs, maps, ndcgs = [], [], [], []
-        for names, apis, toks, descs, _ in tqdm(data_loader):
-            names, apis, toks = gVar(names), gVar(apis), gVar(toks)
-            code_repr = model.eval().code_encoding(names, apis, toks)
-            for it in range(poolsize):
-                desc = gVar(descs[it].expand(poolsize, -1))
-                desc_repr = model.eval().desc_encoding(desc)
-                n_results = K
-                sims = F.cosine_similarity(code_repr, desc_repr).data.cpu().numpy()
-                negsims = np.negative(sims)
-                prediction = np.argpartition(negsims, kth=n_results - 1)
-                prediction = prediction[:n_results]
-                # sort the codes by their sim, simulate a ranking
-                prediction = [y for _, y in sorted(zip(negsims[prediction], prediction))]
-                real_value = [it]
-                accs.append(ACC(real_value, prediction))
-                mrrs.append(MRR(real_value, prediction))
-                maps.append(MAP(real_value, prediction))
-                ndcgs.append(NDCG(real_value, prediction))
-
-        mean_acc = np.mean(accs)
-        mean_mrr = np.mean(mrrs)
-        mean_map = np.mean(maps)
-        mean_ndcg = np.mean(ndcgs)
+            self.validation_set = load_dataset(self.model_params, 'valid', load_in_memory=True, bad_descs=False)
+
+        # every code and desc of a pool is encoded once, in batches
+        batch_size = len(self.validation_set) if poolsize == -1 else poolsize
+        encode_size = self.model_params['repr_batch_size']
+        pools = [np.arange(i, i + batch_size) for i in range(0, len(self.validation_set) - batch_size + 1, batch_size)]
+        data_loader = batch_loader(self.validation_set, pools, num_workers=1, pin_memory=True)
+
+        ranks = []
+        profiler = self.profiler('eval')
+        try:
+            with torch.no_grad():
+                for names, apis, toks, descs in tqdm(profiler.iterate(data_loader), total=len(pools)):
+                    code_reprs, desc_reprs = [], []
+                    with profiler.stage('encode'):
+                        for i in range(0, len(names), encode_size):
+                            rows = slice(i, i + encode_size)
+                            code_reprs.append(model.eval().code_encoding(gVar(names[rows]), gVar(apis[rows]),
+                                                                         gVar(toks[rows])).data.cpu().numpy())
+                            desc_reprs.append(model.eval().desc_encoding(gVar(descs[rows])).data.cpu().numpy())
+                    # cosine similarities of the whole pool, by tiles for the whole test set
+                    with profiler.stage('rank'):
+                        ranks.append(pool_ranks(normalize(np.concatenate(desc_reprs)),
+                                                normalize(np.concatenate(code_reprs)), self.model_params['eval_tile']))
+                    profiler.step(len(names))
+        finally:
+            profiler.close()
+
+        mean_acc, mean_mrr, mean_map, mean_ndcg = ranking_metrics(np.concatenate(ranks), K)
 
         logger.info('ACC={}, MRR={}, MAP={}, nDCG={}'.format(mean_acc, mean_mrr, mean_map, mean_ndcg))
 
         return mean_acc, mean_mrr, mean_map, mean_ndcg
 
     # Compute Representation
+    def load_use_set(self):
+        from data import load_dataset
+
+        return load_dataset(self.model_params, 'use', load_in_memory=True)
+
+    def bucketing(self):
+        # trimming the padding only leaves the representations unchanged with pad aware encoders
+        return self.model_params['bucket_batches'] and self.model_params['pad_aware']
+
+    def repr_loader(self, dataset, start=0):
+        """
+        batches of row ids of `dataset` from `start`, in the order they are encoded, and their data loader.
+        With bucketing, the rows of every window of `bucket_window` batches are encoded in length order.
+        return: (batches, data loader, window size in rows)
+        """
+        from data import BucketBatchSampler, batch_loader
+
+        batch_size = self.model_params['repr_batch_size']
+        if self.bucketing():
+            window = self.model_params['bucket_window']
+            batches = [batch + start for batch in
+                       BucketBatchSampler(dataset.lengths()[start:], batch_size, shuffle=False, window=window)]
+        else:
+            window = 1
+            batches = [np.arange(i, min(i + batch_size, len(dataset))) for i in range(start, len(dataset), batch_size)]
+        data_loader = batch_loader(dataset, batches, trim=self.bucketing(), num_workers=2, pin_memory=True)
+        return batches, data_loader, batch_size * window
+
     def repr_code(self, model, norm=True):
+        from models import JointEmbeder
+        from reindex import drop_hashes
+
+        # every path rewrites the store, the row digests of the last re-index no longer describe it
+        drop_hashes(self.path + self.model_params['use_codevecs'])
+        # the processes rebuild a JointEmbeder from its weights
+        if self.model_params['repr_processes'] > 1 and isinstance(model, JointEmbeder):
+            from parallel_repr import repr_code_parallel
+
+            return repr_code_parallel(self.model_params, model, norm, self.model_epoch or 0)
+        if self.model_params['repr_streaming']:
+            return self.repr_code_streaming(model, norm)
+
         logging.info("Start Code Representation")
-        use_set = CodeSearchDataset(self.model_params['workdir'],
-                                    self.model_params['use_names'], self.model_params['name_len'],
-                                    self.model_params['use_apis'], self.model_params['api_len'],
-                                    self.model_params['use_tokens'], self.model_params['tokens_len'],
-                                    load_in_memory=True)
+        use_set = self.load_use_set()
 
-        data_loader = torch.utils.data.DataLoader(dataset=use_set, batch_size=1000,
-                                                  shuffle=False, drop_last=False, num_workers=2, pin_memory=True)
+        batches, data_loader, _ = self.repr_loader(use_set)
 
         vecs = []
         logging.debug("Calculating code vectors")
-        for itr, (names, apis, toks) in enumerate(data_loader, start=1):
-            names, apis, toks = gVar(names), gVar(apis), gVar(toks)
-            reprs = model.eval().code_encoding(names, apis, toks).data.cpu().numpy()
-            vecs.append(reprs)
-            if itr % 100 == 0:
-                logger.info('itr:{}/{}'.format(itr, len(use_set) // 1000))
+        profiler = self.profiler('repr_code')
+        try:
+            for itr, (names, apis, toks) in enumerate(profiler.iterate(data_loader), start=1):
+                with profiler.stage('encode'):
+                    names, apis, toks = gVar(names), gVar(apis), gVar(toks)
+                    reprs = model.eval().code_encoding(names, apis, toks).data.cpu().numpy()
+                vecs.append(reprs)
+                profiler.step(len(reprs))
+                if itr % 100 == 0:
+                    logger.info('itr:{}/{}'.format(itr, len(batches)))
+        finally:
+            profiler.close()
 
         logging.debug("Concatenating all vectors")
-        vecs = np.concatenate(vecs, 0)
+        vecs = np.concatenate(vecs, 0)[np.argsort(np.concatenate(batches))]  # back to row order
 
         if norm:
             logger.debug("Normalizing...")
             vecs = normalize(vecs)
 
         logging.debug("Writing to disk -  vectors")
-        save_vecs(vecs, self.path + self.model_params['use_codevecs'])
+        save_vecs(vecs, self.path + self.model_params['use_codevecs'], self.model_params['codevecs_dtype'], norm)
         return vecs
 
-    def search(self, model, query, n_results=10):
-        desc = sent2indexes(query, self.vocab_desc)  # convert desc sentence into word indices
-        logger.debug("Description representation")
-        desc = np.expand_dims(desc, axis=0)
-        desc = gVar(desc)
-        logger.debug("Description embedding")
-        desc_repr = model.eval().desc_encoding(desc).data.cpu().numpy()
-
-        valued = []
-        threads = []
-        for i, codevecs_chunk in enumerate(self.codevecs):
-            # select the best n_results from each chunk
-            t = threading.Thread(target=self.search_thread,
-                                 args=(valued, desc_repr, codevecs_chunk, i, n_results))
-            threads.append(t)
-        for t in threads:
-            t.start()
-        for t in threads:  # wait until all sub-threads finish
-            t.join()
-
-        valued.sort(reverse=True)
-
-        return valued[:n_results]
-
-    def search_thread(self, valued, desc_repr, codevecs, i, n_results):
-        # 1. compute code similarities
-        chunk_sims = dot_np(normalize(desc_repr), codevecs)
-
-        # 2. choose the top K results
-        negsims = np.negative(chunk_sims[0])
-        maxinds = np.argpartition(negsims, kth=n_results - 1)
-        maxinds = maxinds[:n_results]
-        logger.debug("max inds")
-        logger.debug(maxinds)
-        valued.extend((chunk_sims[0][k], self.codebase[i][k]) for k in maxinds)
+    def repr_code_streaming(self, model, norm=True):
+        """
+        Pipelined code representation: the data loader workers read the next batches while the model
+        encodes the current one and a writer thread normalizes and appends the previous ones to
+        `<use_codevecs>.partial`. Memory does not depend on the corpus size. The vector store count is
+        the checkpoint: a restart with the same model, epoch and use set (`<partial>.meta.json`) resumes
+        after the last written row and the finished store is renamed to `use_codevecs`.
+        """
+        import torch
+
+        logging.info("Start Streaming Code Representation")
+        fout = self.path + self.model_params['use_codevecs']
+        partial = fout + '.partial'
+        use_set = self.load_use_set()
+
+        # a partial store of another model, epoch or use set is started over
+        meta = {'model_name': self.model_params['model_name'], 'epoch': self.model_epoch or 0, 'rows': len(use_set)}
+        start = 0
+        if os.path.exists(partial):
+            header = read_header(partial)
+            if header.dim == self.model_params['n_hidden'] and header.normalized == norm \
+                    and header.dtype == np.dtype(self.model_params['codevecs_dtype']) and read_meta(partial) == meta:
+                start = header.count
+                logger.info("Resuming code representation at row {}/{}".format(start, len(use_set)))
+            else:
+                logger.info("Discarding {}, written by another model or for other rows".format(partial))
+        if start == 0:
+            create_store(partial, self.model_params['n_hidden'], self.model_params['codevecs_dtype'], norm)
+            write_meta(partial, meta)
+
+        batches, data_loader, window_size = self.repr_loader(use_set, start)
+
+        # bounded, so a slow disk makes the encoder wait instead of piling up vectors
+        pending = Queue(maxsize=self.model_params['repr_queue_size'])
+        errors = []
+        finished = object()  # all the rows were encoded, the last window is complete however short
+
+        def write():
+            # a window is written once complete and in row order, so the store count stays a valid checkpoint
+            window, n_rows = [], 0
+            while True:
+                item = pending.get()
+                if item is None:  # encoding aborted, the rows of an unfinished window are not contiguous
+                    return
+                if item is not finished:
+                    window.append(item)
+                    n_rows += len(item[0])
+                if errors:  # keep draining so that the encoder never blocks
+                    window, n_rows = [], 0
+                elif window and (item is finished or n_rows >= window_size):
+                    try:
+                        rows, reprs = (np.concatenate(field) for field in zip(*window))
+                        reprs = reprs[np.argsort(rows)]
+                        append_vecs(partial, normalize(reprs) if norm else reprs)
+                    except Exception as e:
+                        errors.append(e)
+                    window, n_rows = [], 0
+                if item is finished:
+                    return
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        profiler = self.profiler('repr_code')
+        completed = False
+        try:
+            with torch.no_grad():
+                for itr, (rows, (names, apis, toks)) in enumerate(zip(batches, profiler.iterate(data_loader)),
+                                                                  start=1):
+                    if errors:
+                        break
+                    with profiler.stage('encode'):
+                        names, apis, toks = gVar(names), gVar(apis), gVar(toks)
+                        reprs = model.eval().code_encoding(names, apis, toks).data.cpu().numpy()
+                    with profiler.stage('write_wait'):  # the writer is behind when the queue is full
+                        pending.put((rows, reprs))
+                    profiler.step(len(rows))
+                    if itr % 100 == 0:
+                        logger.info('itr:{}/{}'.format(itr, len(batches)))
+            completed = not errors
+        finally:
+            # on an interruption the partial window is dropped, the next run encodes it again
+            pending.put(finished if completed else None)
+            writer.join()
+            profiler.close()
+        if errors:
+            raise errors[0]
+
+        os.replace(partial, fout)
+        os.remove(partial + META_SUFFIX)
+        logger.info("Code vectors written to {}".format(fout))
+        return load_vecs(fout)
+
+    def check_caches(self):
+        """
+        drop the cached vectors when the model epoch changed
+        and the cached results when the code vectors file changed too
+        """
+        stat = os.stat(self.path + self.model_params['use_codevecs'])
+        fingerprint = (stat.st_mtime_ns, stat.st_size, self.model_epoch)
+        if fingerprint != self.cache_fingerprint:
+            if self.cache_fingerprint is not None:
+                logger.info("Code vectors or model changed, clearing the search caches")
+            if self.cache_fingerprint is None or self.cache_fingerprint[2] != self.model_epoch:
+                self.desc_cache.clear()
+            self.result_cache.clear()
+            self.cache_fingerprint = fingerprint
+
+    def snapshot(self):
+        """consistent (search engine, codebase, version) view of the index, swapped by the online updates"""
+        with self.index_lock:
+            return self.search_engine, self.codebase, self.index_version
+
+    def export_metrics(self):
+        """MetricsExporter of conf['metrics_file'], started, or None when the metrics are not written to a file"""
+        if not (self.metrics.enabled and self.model_params['metrics_file']):
+            return None
+        return MetricsExporter(self.metrics, self.model_params['metrics_file'],
+                               self.model_params['metrics_interval']).start()
+
+    def cache_stats(self):
+        return {'desc': self.desc_cache.stats(), 'results': self.result_cache.stats()}
+
+    def record_cache_metrics(self):
+        """hits, misses and size of the caches as gauges, e.g. codesearch_results_cache_hits"""
+        if self.metrics.enabled:
+            for cache, stats in self.cache_stats().items():
+                for key in ('hits', 'misses', 'size'):
+                    self.metrics.set('{}_cache_{}'.format(cache, key), stats[key])
+
+    def search(self, model, query, n_results=10, nprobe=None):
+        """
+        nprobe: number of IVF lists to scan, overrides conf['nprobe'].
+        Only for the ivf search index, ValueError otherwise
+        """
+        metrics = self.metrics
+        with metrics.time('query'):
+            with metrics.time('tokenize'):
+                desc = self.tokenizer([query])  # convert desc sentence into a padded row of word indices
+            tokens = tuple(desc[0].tolist())
+            self.check_caches()
+            search_engine, codebase, version = self.snapshot()
+            if nprobe is not None and not isinstance(search_engine, IVFSearchEngine):
+                raise ValueError("nprobe only applies to the ivf search index, not to '{}'".format(
+                    self.model_params['search_index']))
+
+            result = self.result_cache.get((tokens, n_results, nprobe, version))
+            if result is None:
+                desc_repr = self.desc_cache.get(tokens)
+                if desc_repr is None:
+                    # normalized once, every block of the search reuses it
+                    with metrics.time('encode'):
+                        desc_repr = normalize(self.desc_vectors(model, desc))[0]
+                    self.desc_cache.put(tokens, desc_repr)
+
+                # score all the blocks and keep only the row ids of the best results
+                with metrics.time('search'):
+                    if nprobe is not None:  # IVFSearchEngine
+                        scores, ids = search_engine.search(desc_repr, n_results, nprobe=nprobe)
+                    else:
+                        scores, ids = search_engine.search(desc_repr, n_results)
+                found = np.isfinite(scores)  # drop the deleted rows
+                result = scores[found], ids[found]
+                self.result_cache.put((tokens, n_results, nprobe, version), result)
+            scores, ids = result
+            logger.debug("{} results, best score {}".format(len(ids), scores[0] if len(scores) else None))
+
+            # the snippets are only fetched for the final results
+            with metrics.time('snippets'):
+                snippets = codebase.get(ids)
+        metrics.inc('queries')
+        metrics.inc('results', len(ids))
+        metrics.set('index_size', len(search_engine))
+        self.record_cache_metrics()
+        return list(zip(scores, snippets))
+
+    def encode_descs(self, model, descs):
+        """
+        descs: list of word indices arrays or a padded matrix (see Tokenizer)
+        return: [n x n_hidden] normalized desc vectors
+        """
+        batch = pad_batch(descs, self.model_params['desc_len'])  # one padded desc_encoding call
+        return normalize(self.desc_vectors(model, batch))
+
+    @staticmethod
+    def desc_vectors(model, descs):
+        """unnormalized vectors of a padded [n x desc_len] array, with a torch model or a NumpyDescEncoder"""
+        if getattr(model, 'torch_free', False):
+            return model.desc_encoding(descs)
+        return model.eval().desc_encoding(gVar(descs)).data.cpu().numpy()
+
+    def search_batch(self, model, descs, n_results=10):
+        """
+        descs: list of word indices arrays, scored together with one matrix-matrix product.
+        return: (scores, ids), [n x n_results] each
+        """
+        with self.metrics.time('encode_batch'):
+            desc_reprs = self.encode_descs(model, descs)
+        with self.metrics.time('search_batch'):
+            return self.search_engine.search_batch(desc_reprs, n_results)
 
 
 def parse_args():
     parser = argparse.ArgumentParser("Train and Test Code Search(Embedding) Model")
-    parser.add_argument("--mode", choices=["train", "eval", "repr_code", "search"], default='train',
+    parser.add_argument("--mode", choices=["train", "eval", "repr_code", "search", "serve", "batch_search",
+                                           "reindex", "export"], default='train',
                         help="The mode to run. The `train` mode trains a model;"
                              " the `eval` mode evaluate models in a test set "
                              " The `repr_code/repr_desc` mode computes vectors"
-                             " for a code snippet or a natural language description with a trained model.")
+                             " for a code snippet or a natural language description with a trained model."
+                             " The `serve` mode answers search queries over HTTP (see server.py)"
+                             " and the `batch_search` mode searches all the queries of a file (see batch_search.py)."
+                             " The `reindex` mode is an incremental `repr_code` that only encodes new snippets."
+                             " The `export` mode writes the torch-free desc encoder (see np_encoder.py)"
+                             " and the quantized TorchScript encoders (see export.py).")
     parser.add_argument("-n", "--num", type=int, default=10)
+    parser.add_argument("--input", default='-', help="queries file of the `batch_search` mode, - for stdin")
+    parser.add_argument("--output", default='-', help="results file of the `batch_search` mode, - for stdout")
+    parser.add_argument("--snippets", action="store_true", help="include the snippets in the `batch_search` results")
     parser.add_argument("--verbose", action="store_true", default=True, help="Be verbose")
     return parser.parse_args()
 
@@ -304,21 +761,29 @@ if __name__ == '__main__':
     args = parse_args()
     conf = get_config()
     searcher = CodeSearcher(conf)
-
-    # Define model
-    logger.info('Build Model')
-    _model = JointEmbeder(conf)  # initialize the model
-
-    if conf['reload'] > 0:
-        searcher.load_model_epoch(_model, conf['reload'])
-
-    _model = _model.cuda() if torch.cuda.is_available() else _model
-
-    optimizer = optim.Adam(_model.parameters(), lr=conf['lr'])
+    exporter = searcher.export_metrics() if MODE_ROLES[args.mode] == 'search' else None
+
+    # Define model, with only the parts and weights of the role of the mode
+    role = MODE_ROLES[args.mode]
+    if role == 'search':
+        # search workers x BLAS threads bounded by the number of cores, for the whole process
+        limit_blas_threads(conf['blas_threads'])
+    _model = None
+    if conf['numpy_desc_encoder'] and role == 'search':
+        logger.info('Load NumPy desc encoder')
+        _model = searcher.load_numpy_encoder(conf['reload'])
+    elif conf['use_export'] and role in ('repr_code', 'search'):
+        logger.info('Load exported model')
+        _model = searcher.load_export(conf['reload'])
+    if _model is None:
+        logger.info('Build Model ({} role)'.format(role))
+        _model = searcher.load_model(role, conf['reload'])
 
     if args.mode == 'train':
+        from torch import optim
+
         logging.info("Start Training")
-        searcher.train(_model)
+        searcher.train(_model, optim.Adam(_model.parameters(), lr=conf['lr']))
 
     elif args.mode == 'eval':
         logging.info("Start eval")
@@ -329,6 +794,26 @@ if __name__ == '__main__':
         logging.info("Start code representation")
         searcher.repr_code(_model)
 
+    elif args.mode == 'export':
+        from export import check_support, export
+        from np_encoder import export_desc_encoder, NPZ_SUFFIX
+
+        logging.info("Start export")
+        export_desc_encoder(_model, searcher.export_prefix(conf['reload']) + NPZ_SUFFIX)
+        try:
+            check_support(conf['export_quantize'])
+        except RuntimeError as e:
+            # the pinned torch 0.4.1 cannot save TorchScript graphs, the NumPy export is enough for search
+            logger.warning("{}: only the NumPy desc encoder was exported".format(e))
+        else:
+            export(_model, searcher.export_prefix(conf['reload']), conf, conf['export_quantize'])
+
+    elif args.mode == 'reindex':
+        from reindex import reindex
+
+        logging.info("Start incremental code representation")
+        reindex(searcher, _model)
+
     elif args.mode == 'search':
         logging.info("Start Searching")
         # search code based on a desc
@@ -347,3 +832,19 @@ if __name__ == '__main__':
             results = '\n\n'.join(map(str, snippets))  # combine the result into a returning string
             print(results)
             print("-" * 20)
+
+    elif args.mode == 'serve':
+        from server import serve
+
+        logging.info("Start Serving")
+        serve(searcher, _model, conf)
+
+    elif args.mode == 'batch_search':
+        from batch_search import batch_search, open_or_std
+
+        logging.info("Start Batch Searching")
+        with open_or_std(args.input, 'r') as _fin, open_or_std(args.output, 'w') as _fout:
+            batch_search(searcher, _model, _fin, _fout, args.num, args.snippets)
+
+    if exporter is not None:
+        exporter.stop()
@@ -18,7 +18,10 @@ def get_config():
         'use_apis': 'use.apiseq.h5',
         'use_tokens': 'use.tokens.h5',
         # results data(code vectors)
-        'use_codevecs': 'use.codevecs100.128.normalized.h5',  # 'use.codevecs.h5', 'use.codevecs.normalized.h5'
+        'use_codevecs': 'use.codevecs100.128.normalized.vecs',  # vector store, see vecstore.py
+        'codevecs_dtype': 'float32',  # 'float32', 'float16'
+
+        'dataset_arrays': True,  # read padded int32 .npy matrices (built once next to the hdf5 files), memory mapped
 
         # parameters
         'name_len': 6,
@@ -34,32 +37,86 @@ def get_config():
 
         # training_params
         'batch_size': 128,
-        'chunk_size': 2000000,
         'nb_epoch': 1000,
         'validation_split': 0.2,
         # 'optimizer': 'adam',
         'lr': 0.001,
         'valid_every': 5,
         'n_eval': 100,
+        'eval_tile': 4096,  # descs x codes similarities computed at once by `eval`
         'evaluate_all_threshold': {
             'mode': 'all',
             'top1': 0.4,
         },
+        'bucket_batches': True,  # batches of similar lengths trimmed to their longest sequence (needs pad_aware)
+        'bucket_window': 100,  # batches sorted by length together, shuffled afterwards for training
         'log_every': 100,
         'save_every': 5,
+        'profile': False,  # per-iteration data wait and stage times of train/repr_code/eval (see profiler.py)
+        'profile_dir': 'profiles/',  # under workdir, JSON lines traces <mode>.trace.jsonl
+        'profile_every': 100,  # iterations between two logged profile summaries
+        'torch_profile': None,  # (first iteration, n iterations) recorded by the torch autograd profiler
         'reload': 100,  # epoch that the model is reloaded from . If reload=0, then train from scratch
 
         'model_name': "java_cs",
 
+        # repr_code_params
+        'repr_batch_size': 1000,
+        'repr_streaming': True,  # encode, normalize and append the vectors in a pipeline, resumable
+        'repr_queue_size': 8,  # encoded batches waiting to be written
+        'repr_processes': 1,  # > 1: encode contiguous shards of the use data in parallel processes (CPU)
+        'repr_threads_per_process': 1,  # torch intra-op threads of every encoding process
+
+        # export_params
+        'export_quantize': True,  # int8 dynamic quantization of the Linear layers of the export
+        'use_export': False,  # encode with the export of epoch `reload` in repr_code/reindex/search/serve/batch_search
+        'numpy_desc_encoder': False,  # encode the queries of search/serve/batch_search with the NumPy export
+
+        # search_params
+        'chunk_size': 262144,  # rows of code vectors scored by one search task
+        'search_workers': 4,  # threads of the persistent search pool
+        'blas_threads': 1,  # BLAS threads of the search roles and of each search process (needs threadpoolctl)
+        'search_processes': 0,  # > 1: exact search over row slices of the vector store owned by worker
+                                # processes (see process_search.py) instead of the threads
+        'search_index': 'exact',  # 'exact', 'ivf' (build it with `python ivf.py build`),
+                                  # 'sq8', 'pq' (build them with `python quantize.py build`)
+        'ivf_nlist': 4096,  # number of IVF lists (k-means centroids)
+        'nprobe': 16,  # number of IVF lists scanned per query
+        'pq_m': 50,  # number of PQ sub-vectors (must divide n_hidden)
+        'rerank': 100,  # candidates of the quantized scan re-ranked with the full precision vectors
+        'token_cache_size': 10000,  # query words whose ids are memoized by the tokenizer
+        'desc_cache_size': 10000,  # query vectors kept in the LRU cache of `search` (0 disables it)
+        'result_cache_size': 10000,  # ranked results kept in the LRU cache of `search` (0 disables it)
+        'compact_threshold': 0.1,  # fraction of deleted snippets that triggers a background compaction
+        'index_save_rows': 10000,  # snippets added online between two saves of the ivf/quantized index
+        'metrics': False,  # per-stage latency histograms and counters of the search (see metrics.py)
+        'metrics_file': None,  # Prometheus text file rewritten every `metrics_interval` seconds when set
+        'metrics_interval': 10,
+
+        # server_params
+        'server_host': '127.0.0.1',
+        'server_port': 8000,
+        'server_socket': None,  # path of a Unix socket, used instead of host/port when set
+        'batch_window_ms': 5,  # time a micro-batch waits for more queries after the first one
+        'max_batch_size': 64,  # queries encoded and scored together
+
+        # batch_search_params
+        'batch_query_tile': 256,  # queries encoded and scored together
+        'batch_code_tile': 16384,  # code vectors scored against a tile of queries by one task
+
         # model_params
         'emb_size': 100,
         'n_hidden': 400,  # number of hidden dimension of code/desc representation
         # recurrent
         'lstm_dims': 200,  # * 2
+        'pad_aware': False,  # LSTM encoders skip the padding (packed sequences) and never pool it. Changes the
+                             # vectors: only for models trained with it, then re-encode the code vectors
         'init_embed_weights_methname': None,  # 'word2vec_100_methname.h5',
         'init_embed_weights_tokens': None,  # 'word2vec_100_tokens.h5',
         'init_embed_weights_desc': None,  # 'word2vec_100_desc.h5',
         'margin': 0.05,
+        'negatives': 'random',  # 'random': one random bad desc per example, 'batch': all the other descs
+                                # of the batch, 'hardest': the most similar other desc of the batch
         'sim_measure': 'cos',  # similarity measure: gesd, cosine, aesd
 
     }
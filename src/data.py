@@ -1,4 +1,5 @@
-import pickle
+import logging
+import os
 import random
 from functools import partial
 
@@ -6,13 +7,22 @@ import numpy as np
 import tables
 import torch
 import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
+
+from vecstore import load_vecs, save_vecs  # noqa: F401, re-exported
+from vocab import PAD_token, SOS_token, EOS_token, UNK_token, load_dict  # noqa: F401, re-exported
+
+logger = logging.getLogger(__name__)
 
 use_cuda = torch.cuda.is_available()
 
-PAD_token = 0
-SOS_token = 1
-EOS_token = 2
-UNK_token = 3
+ARRAY_SUFFIX = '.{}.npy'
+# config keys of the (method name, API sequence, tokens, description) files of every split
+SPLITS = {
+    'train': ('train_name', 'train_api', 'train_tokens', 'train_desc'),
+    'valid': ('valid_name', 'valid_api', 'valid_tokens', 'valid_desc'),
+    'use': ('use_names', 'use_apis', 'use_tokens', None),
+}
 
 
 class CodeSearchDataset(data.Dataset):
@@ -21,7 +31,7 @@ class CodeSearchDataset(data.Dataset):
     """
 
     def __init__(self, data_dir, f_name, name_len, f_api, api_len,
-                 f_tokens, tok_len, f_descs=None, desc_len=None, load_in_memory=False):
+                 f_tokens, tok_len, f_descs=None, desc_len=None, load_in_memory=False, bad_descs=True):
 
         load = tables.open_file
         if load_in_memory:
@@ -31,6 +41,8 @@ class CodeSearchDataset(data.Dataset):
         self.api_len = api_len
         self.tok_len = tok_len
         self.desc_len = desc_len
+        # without them, the training uses the other descriptions of the batch as negatives
+        self.bad_descs = bad_descs
         # 1. Initialize file path or list of file names.
         """read training data(list of int arrays) from a hdf5 file"""
         self.training = False
@@ -57,6 +69,17 @@ class CodeSearchDataset(data.Dataset):
         self.data_len = self.idx_names.shape[0]
         print("{} entries".format(self.data_len))
 
+    def lengths(self):
+        """
+        bucketing key of every example: the real (truncated) length of the sequences
+        that go through an LSTM, method name, API sequence and description
+        """
+        lengths = np.minimum(self.idx_names[:]['length'], self.name_len).astype(np.int64)
+        lengths += np.minimum(self.idx_apis[:]['length'], self.api_len)
+        if self.training:
+            lengths += np.minimum(self.idx_descs[:]['length'], self.desc_len)
+        return lengths
+
     def pad_seq(self, seq, maxlen):
         if len(seq) < maxlen:
             seq = np.append(seq, [PAD_token] * maxlen)
@@ -82,6 +105,8 @@ class CodeSearchDataset(data.Dataset):
             length, pos = self.idx_descs[offset]['length'], self.idx_descs[offset]['pos']
             good_desc = self.descs[pos:pos + length].astype('int64')
             good_desc = self.pad_seq(good_desc, self.desc_len)
+            if not self.bad_descs:
+                return name, apiseq, tokens, good_desc
 
             rand_offset = random.randint(0, self.data_len - 1)
             length, pos = self.idx_descs[rand_offset]['length'], self.idx_descs[rand_offset]['pos']
@@ -96,21 +121,172 @@ class CodeSearchDataset(data.Dataset):
         return self.data_len
 
 
-def load_dict(filename):
-    with open(filename, 'rb') as f:
-        return pickle.load(f)
+def build_array(fname, maxlen, fout, chunk_rows=65536):
+    """write the sequences of a phrases/indices hdf5 file as a [n_rows, maxlen] int32 matrix padded with PAD_token"""
+    with tables.open_file(fname) as h5f:
+        phrases = h5f.get_node('/phrases')
+        index = h5f.get_node('/indices')[:]
+        tmp = fout + '.tmp'
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int32, shape=(len(index), maxlen))
+        cols = np.arange(maxlen)
+        for start in range(0, len(index), chunk_rows):
+            pos = index[start:start + chunk_rows]['pos'].astype(np.int64)
+            lengths = np.minimum(index[start:start + chunk_rows]['length'], maxlen).astype(np.int64)
+            mask = cols < lengths[:, None]
+            block = np.full(mask.shape, PAD_token, dtype=np.int32)
+            if mask.any():
+                low, high = pos[lengths > 0].min(), (pos + lengths).max()
+                seqs = phrases[low:high]
+                block[mask] = seqs[(pos[:, None] - low + cols)[mask]]
+            out[start:start + chunk_rows] = block
+        out.flush()
+        del out
+    os.replace(tmp, fout)
+
+
+def load_array(fname, maxlen, load_in_memory=False):
+    """padded matrix of a phrases/indices hdf5 file, (re)built next to it when missing or stale"""
+    fout = fname + ARRAY_SUFFIX.format(maxlen)
+    if not os.path.exists(fout) or os.path.getmtime(fout) < os.path.getmtime(fname):
+        logger.info("Building {}".format(fout))
+        build_array(fname, maxlen, fout)
+    return np.load(fout, mmap_mode=None if load_in_memory else 'r')
 
 
-def load_vecs(fin):
-    """read vectors (2D numpy array) from a hdf5 file"""
-    with tables.open_file(fin) as h5f:
-        return np.array(h5f.root.vecs)
+class ArrayDataset(data.Dataset):
+    """
+    Same examples as CodeSearchDataset, read from padded int32 matrices (see `load_array`).
+    The matrices are memory mapped, so the data loader workers share the page cache instead of
+    holding their own copy, and whole batches are fetched with one fancy indexing per field:
+    `dataset[rows]` with an array of rows returns the fields of the batch (see `batch_loader`).
+    """
+
+    def __init__(self, data_dir, f_name, name_len, f_api, api_len,
+                 f_tokens, tok_len, f_descs=None, desc_len=None, load_in_memory=False, bad_descs=True):
+        self.names = load_array(data_dir + f_name, name_len, load_in_memory)
+        self.apis = load_array(data_dir + f_api, api_len, load_in_memory)
+        self.tokens = load_array(data_dir + f_tokens, tok_len, load_in_memory)
+        self.training = f_descs is not None
+        self.bad_descs = bad_descs
+        if self.training:
+            self.descs = load_array(data_dir + f_descs, desc_len, load_in_memory)
+            assert len(self.names) == len(self.descs)
+        assert len(self.names) == len(self.apis) == len(self.tokens)
+        self.data_len = len(self.names)
+        logger.info("{} entries".format(self.data_len))
+
+    def lengths(self):
+        """see CodeSearchDataset.lengths"""
+        fields = [self.names, self.apis] + ([self.descs] if self.training else [])
+        return sum(np.count_nonzero(field != PAD_token, axis=1) for field in fields)
+
+    def __getitem__(self, rows):
+        rows = np.asarray(rows)
+        fields = [self.names[rows], self.apis[rows], self.tokens[rows]]
+        if self.training:
+            fields.append(self.descs[rows])
+        if self.training and self.bad_descs:
+            if rows.ndim:
+                rand_rows = np.array([random.randint(0, self.data_len - 1) for _ in range(len(rows))], dtype=np.int64)
+            else:
+                rand_rows = random.randint(0, self.data_len - 1)
+            fields.append(self.descs[rand_rows])
+        return tuple(field.astype('int64') for field in fields)
+
+    def __len__(self):
+        return self.data_len
+
+
+def load_dataset(conf, split, load_in_memory=False, bad_descs=True):
+    """
+    dataset of a split ('train', 'valid' or 'use'), array backed with conf['dataset_arrays'].
+    load_in_memory: load the hdf5 files in memory (ignored by the array backed datasets)
+    bad_descs: draw a random negative description for every example (train and valid splits)
+    """
+    f_name, f_api, f_tokens, f_descs = SPLITS[split]
+    files = (conf['workdir'],
+             conf[f_name], conf['name_len'],
+             conf[f_api], conf['api_len'],
+             conf[f_tokens], conf['tokens_len'],
+             conf[f_descs] if f_descs else None, conf['desc_len'] if f_descs else None)
+    if conf['dataset_arrays']:
+        # memory mapped: every process reading the dataset shares the page cache
+        return ArrayDataset(*files, bad_descs=bad_descs)
+    return CodeSearchDataset(*files, load_in_memory=load_in_memory, bad_descs=bad_descs)
 
 
-def save_vecs(vecs, fout):
-    with tables.open_file(fout, 'w') as fvec:
-        atom = tables.Atom.from_dtype(vecs.dtype)
-        filters = tables.Filters(complib='blosc', complevel=5)
-        ds = fvec.create_carray(fvec.root, 'vecs', atom, vecs.shape, filters=filters)
-        ds[:] = vecs
-        print('done')
+class BucketBatchSampler(data.Sampler):
+    """
+    Batches of examples of similar length. The examples are split in windows of `window` batches,
+    sorted by length inside a window and cut in batches. With shuffle, the examples are shuffled
+    before the split and the batches of all the windows are shuffled afterwards; without it, the
+    batches of a window cover exactly its rows, in length order.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, window=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.window_size = batch_size * window
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.window_size):
+            window = order[start:start + self.window_size]
+            window = window[np.argsort(self.lengths[window], kind='stable')]
+            for i in range(0, len(window), self.batch_size):
+                batch = window[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        full, rest = divmod(len(self.lengths), self.window_size)
+        per_window = self.window_size // self.batch_size
+        if self.drop_last:
+            return full * per_window + rest // self.batch_size
+        return full * per_window + (rest + self.batch_size - 1) // self.batch_size
+
+
+def trim_batch(fields):
+    """
+    trim the padding shared by all the sequences of a field.
+    The tokens (third field) keep their length: the BOW encoder pools its padding embedding.
+    """
+    trimmed = []
+    for i, field in enumerate(fields):
+        if i != 2:
+            length = max(int(field.ne(PAD_token).long().sum(1).max()), 1)
+            field = field[:, :length].contiguous()
+        trimmed.append(field)
+    return trimmed
+
+
+def trim_collate(batch):
+    return trim_batch(default_collate(batch))
+
+
+def array_collate(batch):
+    # a single item: the fields of a whole batch fetched by ArrayDataset
+    return [torch.from_numpy(field) for field in batch[0]]
+
+
+def array_trim_collate(batch):
+    return trim_batch(array_collate(batch))
+
+
+def batch_loader(dataset, batches, trim=False, **kwargs):
+    """
+    data loader of the given batches of rows (a batch sampler or a list of row arrays).
+    An ArrayDataset fetches every batch at once; trim: see `trim_batch`.
+    """
+    if isinstance(dataset, ArrayDataset):
+        return data.DataLoader(dataset=dataset, sampler=batches, batch_size=1,
+                               collate_fn=array_trim_collate if trim else array_collate, **kwargs)
+    if trim:
+        kwargs['collate_fn'] = trim_collate
+    return data.DataLoader(dataset=dataset, batch_sampler=batches, **kwargs)
@@ -0,0 +1,138 @@
+"""
+CPU inference artifact of a trained JointEmbeder.
+
+`desc_encoding` and `code_encoding` are traced to TorchScript graphs, after a dynamic int8
+quantization of their Linear layers (int8 weights, activations quantized on the fly). The LSTMs
+stay in float: a traced dynamically quantized packed LSTM only runs for the batch size it was
+traced with.
+
+    python codesearcher.py --mode export       # epoch conf['reload']
+    python -m benchmarks.export                # cosine drift and latency against the float model
+
+The graphs are traced for inputs padded to `name_len`, `api_len`, `tokens_len` and `desc_len`,
+InferenceModel pads its inputs to these widths. The export is checked on several batch sizes before
+being written. Needs torch >= 1.3: the pinned 0.4.1 has neither
+dynamic quantization nor TorchScript serialization.
+"""
+import copy
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from data import PAD_token
+
+logger = logging.getLogger(__name__)
+
+DESC_SUFFIX = '_desc.pt'
+CODE_SUFFIX = '_code.pt'
+BATCH_SIZES = (1, 3, 4, 8)  # the graphs must run for any batch size, not only the traced one
+
+
+class DescEncoding(nn.Module):
+    def __init__(self, model):
+        super(DescEncoding, self).__init__()
+        self.desc_encoder = model.desc_encoder
+
+    def forward(self, desc):
+        return self.desc_encoder(desc)
+
+
+class CodeEncoding(nn.Module):
+    """JointEmbeder.code_encoding without the description encoder"""
+
+    def __init__(self, model):
+        super(CodeEncoding, self).__init__()
+        self.name_encoder = model.name_encoder
+        self.api_encoder = model.api_encoder
+        self.tok_encoder = model.tok_encoder
+        self.fuse = model.fuse
+
+    def forward(self, name, api, tokens):
+        code_repr = self.fuse(torch.cat((self.name_encoder(name), self.api_encoder(api), self.tok_encoder(tokens)), 1))
+        return F.tanh(code_repr)
+
+
+def example_batch(width, batch_size=4):
+    """sequences of different lengths, the longest one filling `width`"""
+    batch = np.full((batch_size, width), PAD_token, dtype=np.int64)
+    for i in range(batch_size):
+        batch[i, :max(width - i * width // batch_size, 1)] = 4 + i
+    return torch.from_numpy(batch)
+
+
+def check_support(quantize):
+    if not hasattr(torch.jit, 'save') or (quantize and not hasattr(torch, 'quantization')):
+        raise RuntimeError("Exporting needs torch >= 1.3 (TorchScript serialization{}), found {}".format(
+            ' and dynamic quantization' if quantize else '', torch.__version__))
+
+
+def batch_drift(model, desc_graph, code_graph, conf, batch_sizes=BATCH_SIZES):
+    """
+    {batch size: max 1 - cos} of the graphs against the float `model` on example batches.
+    Raises RuntimeError when a graph cannot run a batch size.
+    """
+    drift = {}
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            desc = example_batch(conf['desc_len'], batch_size)
+            code = tuple(example_batch(conf[key], batch_size) for key in ('name_len', 'api_len', 'tokens_len'))
+            try:
+                pairs = ((model.desc_encoding(desc), desc_graph(desc)),
+                         (model.code_encoding(*code), code_graph(*code)))
+            except RuntimeError as e:
+                raise RuntimeError("The exported graphs fail on a batch of {}: {}".format(batch_size, e))
+            drift[batch_size] = max(float((1 - F.cosine_similarity(a, b)).max()) for a, b in pairs)
+    return drift
+
+
+def export(model, prefix, conf, quantize=True):
+    """write the desc and code encoding graphs to `prefix` + DESC_SUFFIX / CODE_SUFFIX"""
+    check_support(quantize)
+    model = copy.deepcopy(model).cpu().eval()
+    exported = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8) if quantize else model
+    with torch.no_grad():
+        desc_graph = torch.jit.trace(DescEncoding(exported), example_batch(conf['desc_len']))
+        code_graph = torch.jit.trace(CodeEncoding(exported), (example_batch(conf['name_len']),
+                                                              example_batch(conf['api_len']),
+                                                              example_batch(conf['tokens_len'])))
+    drift = batch_drift(model, desc_graph, code_graph, conf)
+    logger.debug("Export drift per batch size: {}".format(drift))
+    torch.jit.save(desc_graph, prefix + DESC_SUFFIX)
+    torch.jit.save(code_graph, prefix + CODE_SUFFIX)
+    logger.info("Exported {}{} and {}{}".format(prefix, DESC_SUFFIX, prefix, CODE_SUFFIX))
+
+
+class InferenceModel:
+    """
+    Exported graphs behind the JointEmbeder inference interface (`eval`, `desc_encoding`, `code_encoding`),
+    on CPU.
+    """
+
+    def __init__(self, prefix, conf):
+        check_support(False)
+        self.desc_graph = torch.jit.load(prefix + DESC_SUFFIX, map_location='cpu')
+        self.code_graph = torch.jit.load(prefix + CODE_SUFFIX, map_location='cpu')
+        self.conf = conf
+
+    def eval(self):
+        return self
+
+    @staticmethod
+    def pad(seqs, width):
+        """pad (or cut) a batch to the traced width"""
+        seqs = seqs.cpu()
+        if seqs.size(1) < width:
+            return F.pad(seqs, (0, width - seqs.size(1)), value=PAD_token)
+        return seqs[:, :width]
+
+    def desc_encoding(self, desc):
+        with torch.no_grad():
+            return self.desc_graph(self.pad(desc, self.conf['desc_len']))
+
+    def code_encoding(self, name, api, tokens):
+        with torch.no_grad():
+            return self.code_graph(self.pad(name, self.conf['name_len']), self.pad(api, self.conf['api_len']),
+                                   self.pad(tokens, self.conf['tokens_len']))
@@ -0,0 +1,222 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from search_engine import top_k
+
+logger = logging.getLogger(__name__)
+
+IVF_SUFFIX = '.ivf.npz'
+
+
+def assign_clusters(vecs, centroids, block_size=65536):
+    """closest centroid (by inner product) of every row of vecs, computed block by block"""
+    assign = np.empty(len(vecs), dtype=np.int64)
+    for i in range(0, len(vecs), block_size):
+        block = np.asarray(vecs[i:i + block_size], dtype=np.float32)
+        assign[i:i + block_size] = np.argmax(np.dot(block, centroids.T), axis=1)
+    return assign
+
+
+def cluster_sums(vecs, assign, n_clusters):
+    order = np.argsort(assign, kind='stable')
+    counts = np.bincount(assign, minlength=n_clusters)
+    sums = np.zeros((n_clusters, vecs.shape[1]), dtype=np.float64)
+    nonempty = np.flatnonzero(counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+    sums[nonempty] = np.add.reduceat(vecs[order].astype(np.float64), starts, axis=0)
+    return sums, counts
+
+
+def kmeans(vecs, n_clusters, n_iter=20, sample_size=262144, seed=42):
+    """
+    spherical k-means (inner product on normalized vectors) trained on a random sample of the rows.
+    return: [n_clusters x dim] normalized float32 centroids
+    """
+    rng = np.random.RandomState(seed)
+    sample_ids = np.sort(rng.choice(len(vecs), min(len(vecs), sample_size), replace=False))
+    sample = np.asarray(vecs[sample_ids], dtype=np.float32)
+    assert n_clusters <= len(sample), 'Cannot train {} clusters with {} vectors'.format(n_clusters, len(sample))
+
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for it in range(n_iter):
+        assign = assign_clusters(sample, centroids)
+        sums, counts = cluster_sums(sample, assign, n_clusters)
+        empty = counts == 0
+        # re-seed the empty clusters with random points
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = (sums / np.linalg.norm(sums, axis=1, keepdims=True)).astype(np.float32)
+        logger.debug("kmeans iteration {}/{}: {} empty clusters".format(it + 1, n_iter, int(empty.sum())))
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file over the code vectors: the ids of the vectors of every cluster are stored
+    contiguously in `list_ids`, the list of cluster c is list_ids[list_offsets[c]:list_offsets[c + 1]].
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vecs, nlist, n_iter=20, sample_size=262144):
+        logger.info("Training {} IVF centroids".format(nlist))
+        centroids = kmeans(vecs, nlist, n_iter, sample_size)
+        logger.info("Assigning {} vectors".format(len(vecs)))
+        assign = assign_clusters(vecs, centroids)
+        list_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(centroids, list_offsets, list_ids)
+
+    def save(self, fname):
+        np.savez(fname, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            return cls(f['centroids'], f['list_offsets'], f['list_ids'])
+
+    def list_clusters(self):
+        """cluster of every entry of list_ids"""
+        return np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+
+    def rebuild(self, ids, clusters):
+        order = np.argsort(clusters, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(clusters, minlength=self.nlist))])
+        return IVFIndex(self.centroids, list_offsets.astype(np.int64), ids[order].astype(np.int64))
+
+    def add(self, vecs, ids):
+        """index with the given new vectors added to their closest lists"""
+        return self.rebuild(np.concatenate([self.list_ids, ids]),
+                            np.concatenate([self.list_clusters(), assign_clusters(vecs, self.centroids)]))
+
+    def compact(self, keep):
+        """index of the vectors selected by the `keep` mask, renumbered in order"""
+        new_ids = np.cumsum(keep) - 1
+        kept = keep[self.list_ids]
+        return self.rebuild(new_ids[self.list_ids[kept]], self.list_clusters()[kept])
+
+    def probe(self, query, nprobe):
+        """ids of the vectors in the `nprobe` clusters closest to the query"""
+        clusters = top_k(np.dot(self.centroids, query), nprobe)
+        return np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in clusters])
+
+
+class IVFSearchEngine:
+    """Approximate search scoring only the vectors of the `nprobe` closest clusters of every query."""
+
+    def __init__(self, vecs, index, nprobe):
+        self.vecs = vecs
+        self.index = index
+        self.nprobe = nprobe
+        self.deleted = None  # optional boolean mask of the tombstoned rows, never returned
+
+    def __len__(self):
+        return len(self.vecs)
+
+    def append(self, vecs):
+        """search `vecs`, the current rows followed by new ones, from now on"""
+        new_ids = np.arange(len(self.vecs), len(vecs))
+        index = self.index.add(np.asarray(vecs[new_ids[0]:], dtype=np.float32), new_ids) \
+            if len(new_ids) else self.index
+        # the vectors first: a search running meanwhile never probes ids past the end of its vectors
+        self.vecs = vecs
+        self.index = index
+
+    def compact(self, vecs, keep):
+        """new engine over `vecs`, the rows of the current ones selected by the `keep` mask"""
+        return IVFSearchEngine(vecs, self.index.compact(keep), self.nprobe)
+
+    def search(self, query, n_results, nprobe=None):
+        ids = np.sort(self.index.probe(query, nprobe or self.nprobe))  # sorted ids read the memmap in order
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.float32), ids
+        sims = np.dot(np.asarray(self.vecs[ids], dtype=np.float32), query)
+        if self.deleted is not None:
+            sims[self.deleted[ids]] = -np.inf
+        best = top_k(sims, n_results)
+        return sims[best], ids[best]
+
+    def search_batch(self, queries, n_results, nprobe=None):
+        results = [self.search(q, n_results, nprobe) for q in queries]
+        width = max(len(i) for _, i in results)
+        scores = np.full((len(results), width), -np.inf, dtype=np.float32)
+        ids = np.full((len(results), width), -1, dtype=np.int64)
+        for row, (s, i) in enumerate(results):
+            scores[row, :len(s)], ids[row, :len(i)] = s, i
+        return scores, ids
+
+
+def recall_at_k(exact_ids, approx_ids):
+    """fraction of the exact top K found by the approximate search, averaged over the queries"""
+    return np.mean([len(np.intersect1d(e, a)) / float(len(e)) for e, a in zip(exact_ids, approx_ids)])
+
+
+def report_recall(vecs, index, queries, n_results, nprobes, exact_engine):
+    """recall@K, latency and scanned fraction of the IVF search for every nprobe, against the exact search"""
+    exact_ids = [exact_engine.search(q, n_results)[1] for q in queries]
+    report = []
+    for nprobe in nprobes:
+        engine = IVFSearchEngine(vecs, index, nprobe)
+        start = time.perf_counter()
+        approx_ids = [engine.search(q, n_results)[1] for q in queries]
+        elapsed = (time.perf_counter() - start) / len(queries)
+        scanned = np.mean([len(index.probe(q, nprobe)) for q in queries]) / len(vecs)
+        report.append({'nprobe': nprobe, 'recall': recall_at_k(exact_ids, approx_ids),
+                       'latency_ms': elapsed * 1000, 'scanned': scanned})
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Build and evaluate the IVF index of the code vectors")
+    parser.add_argument("mode", choices=["build", "recall"])
+    parser.add_argument("--nlist", type=int, default=None, help="number of clusters (default: conf['ivf_nlist'])")
+    parser.add_argument("--iter", type=int, default=20, help="k-means iterations")
+    parser.add_argument("--queries", default=None,
+                        help="vector store of query (desc) vectors, default: sampled code vectors")
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=10, help="recall@K")
+    parser.add_argument("--nprobe", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from configs import get_config
+    from vecstore import load_vecs
+    from search_engine import BlockedSearchEngine, limit_blas_threads
+    from utils import normalize
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    args = parse_args()
+    conf = get_config()
+    vecs_file = conf['workdir'] + conf['use_codevecs']
+    vecs = load_vecs(vecs_file)
+
+    if args.mode == 'build':
+        index = IVFIndex.build(vecs, args.nlist or conf['ivf_nlist'], args.iter)
+        index.save(vecs_file + IVF_SUFFIX)
+        logger.info("IVF index saved to {}".format(vecs_file + IVF_SUFFIX))
+
+    elif args.mode == 'recall':
+        index = IVFIndex.load(vecs_file + IVF_SUFFIX)
+        if args.queries:
+            queries = normalize(np.asarray(load_vecs(args.queries), dtype=np.float32))[:args.n_queries]
+        else:
+            rows = np.random.RandomState(0).choice(len(vecs), min(len(vecs), args.n_queries), replace=False)
+            queries = np.asarray(vecs[np.sort(rows)], dtype=np.float32)
+        limit_blas_threads(conf['blas_threads'])
+        exact = BlockedSearchEngine(vecs, conf['chunk_size'], conf['search_workers'])
+        print("nlist={} queries={} K={}".format(index.nlist, len(queries), args.k))
+        for line in report_recall(vecs, index, queries, args.k, args.nprobe, exact):
+            print("nprobe={nprobe:5d} recall@K={recall:.4f} latency={latency_ms:.3f}ms scanned={scanned:.4f}".format(
+                **line))
+        exact.close()
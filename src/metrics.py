@@ -0,0 +1,189 @@
+"""
+In-process search metrics, exported in the Prometheus text format (GET /metrics of the server, or a
+file rewritten periodically, see MetricsExporter):
+
+    with metrics.time('encode'):       # latency histogram of a stage
+        ...
+    metrics.inc('queries')             # counter
+    metrics.set('index_size', n)       # gauge
+
+The histograms have fixed log-spaced buckets: recording is a bisection and three additions, and
+p50/p95/p99 are interpolated from the buckets. A disabled registry never reads the clock nor locks.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 10us to ~10s, every bucket twice as wide as the previous one
+BUCKETS = tuple(1e-5 * 2 ** i for i in range(21))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """linear interpolation inside the bucket holding the q-th observation (as histogram_quantile)"""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return float('nan')
+        rank, cumulative = q * count, 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):  # above the last bucket
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """stage latency histograms, counters and gauges of one process"""
+
+    def __init__(self, enabled=True, namespace='codesearch'):
+        self.enabled = enabled
+        self.namespace = namespace
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, Histogram())
+        return histogram
+
+    def time(self, stage):
+        """context manager timing a stage"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self.histogram(stage).observe(seconds)
+
+    def inc(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def summary(self):
+        """{stage: {'count', 'mean', 'p50', 'p95', 'p99'}} in seconds, plus the counters and gauges"""
+        stages = {}
+        for stage, histogram in sorted(self.stages.items()):
+            stages[stage] = {'count': histogram.count,
+                             'mean': histogram.sum / histogram.count if histogram.count else 0.0}
+            stages[stage].update(('p{}'.format(int(q * 100)), histogram.quantile(q)) for q in QUANTILES)
+        return {'stages': stages, 'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def render(self):
+        """Prometheus text exposition format"""
+        name = self.namespace + '_stage_seconds'
+        lines = ['# HELP {} Latency of the search stages.'.format(name), '# TYPE {} histogram'.format(name)]
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                    name, stage, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(name, stage, histogram.sum))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram.count))
+        quantiles = self.namespace + '_stage_quantile_seconds'
+        lines += ['# HELP {} In-process quantiles of the search stages latency.'.format(quantiles),
+                  '# TYPE {} gauge'.format(quantiles)]
+        for stage, histogram in sorted(self.stages.items()):
+            for q in QUANTILES:
+                lines.append('{}{{stage="{}",quantile="{}"}} {!r}'.format(quantiles, stage, q, histogram.quantile(q)))
+        for counter, value in sorted(self.counters.items()):
+            lines += ['# TYPE {}_{}_total counter'.format(self.namespace, counter),
+                      '{}_{}_total {}'.format(self.namespace, counter, value)]
+        for gauge, value in sorted(self.gauges.items()):
+            lines += ['# TYPE {}_{} gauge'.format(self.namespace, gauge),
+                      '{}_{} {}'.format(self.namespace, gauge, value)]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, fname):
+        """replace `fname` with the current metrics, readers never see a partial file"""
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, fname)
+
+
+class MetricsExporter:
+    """rewrite the metrics file every `interval` seconds, and once more when stopped"""
+
+    def __init__(self, metrics, fname, interval):
+        self.metrics = metrics
+        self.fname = fname
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.metrics.write(self.fname)
+            except OSError:
+                logger.exception("Cannot write the metrics to {}".format(self.fname))
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.metrics.write(self.fname)
@@ -1,10 +1,12 @@
 import logging
-import os
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as weight_init
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from data import PAD_token
 
 logger = logging.getLogger(__name__)
 
@@ -26,11 +28,12 @@ class BOWEncoder(nn.Module):
 
 
 class SeqEncoder(nn.Module):
-    def __init__(self, vocab_size, emb_size, hidden_size, n_layers=1):
+    def __init__(self, vocab_size, emb_size, hidden_size, n_layers=1, pad_aware=False):
         super(SeqEncoder, self).__init__()
         self.emb_size = emb_size
         self.hidden_size = hidden_size
         self.n_layers = n_layers
+        self.pad_aware = pad_aware
 
         self.embedding = nn.Embedding(vocab_size, emb_size, padding_idx=0)
         self.lstm = nn.LSTM(emb_size, hidden_size, batch_first=True, bidirectional=True)
@@ -42,29 +45,60 @@ class SeqEncoder(nn.Module):
         batch_size, seq_len = _input.size()
         embedded = self.embedding(_input)  # input: [batch_sz x seq_len]  embedded: [batch_sz x seq_len x emb_sz]
         embedded = F.dropout(embedded, 0.25, self.training)
-        rnn_output, hidden = self.lstm(embedded)  # out:[b x seq x hid_sz*2](biRNN)
+        if not self.pad_aware:
+            rnn_output, hidden = self.lstm(embedded)  # out:[b x seq x hid_sz*2](biRNN)
+            rnn_output = F.dropout(rnn_output, 0.25, self.training)
+            output_pool = F.max_pool1d(rnn_output.transpose(1, 2), seq_len).squeeze(2)  # [batch_size x hid_size*2]
+            return F.tanh(output_pool)
+
+        if input_lengths is None:  # sequences are padded at the end
+            input_lengths = _input.ne(PAD_token).long().sum(1)
+        input_lengths = input_lengths.clamp(min=1)  # an empty sequence still runs one (padding) step
+
+        # the LSTM skips the padded steps, packing needs the sequences sorted by decreasing length
+        sorted_lengths, order = input_lengths.sort(0, descending=True)
+        # lengths as a tensor, so that a traced graph does not freeze them
+        packed = pack_padded_sequence(embedded.index_select(0, order), sorted_lengths.cpu(), batch_first=True)
+        rnn_output, hidden = self.lstm(packed)
+        rnn_output, _ = pad_packed_sequence(rnn_output, batch_first=True, total_length=seq_len)
+        _, unorder = order.sort(0)
+        rnn_output = rnn_output.index_select(0, unorder)  # out:[b x seq x hid_sz*2](biRNN)
         rnn_output = F.dropout(rnn_output, 0.25, self.training)
-        output_pool = F.max_pool1d(rnn_output.transpose(1, 2), seq_len).squeeze(2)  # [batch_size x hid_size*2]
+
+        # the padded steps never win the max pooling
+        steps = torch.arange(seq_len, device=_input.device).long().unsqueeze(0)
+        padding = (steps >= input_lengths.unsqueeze(1)).unsqueeze(2)  # [b x seq x 1]
+        output_pool = rnn_output.masked_fill(padding, float('-inf')).max(1)[0]  # [batch_size x hid_size*2]
         encoding = F.tanh(output_pool)
 
         return encoding
 
 
 class JointEmbeder(nn.Module):
-    def __init__(self, config):
+    """
+    parts: encoders to build, 'code' (method name, API sequence, tokens and fuse layer) and/or 'desc'.
+    Training needs both, the search only runs the desc encoder and repr_code the code encoders.
+    """
+
+    def __init__(self, config, parts=('code', 'desc')):
         super(JointEmbeder, self).__init__()
         self.conf = config
         self.margin = config['margin']
-
-        self.name_encoder = SeqEncoder(config['n_words'], config['emb_size'], config['lstm_dims'])
-        self.api_encoder = SeqEncoder(config['n_words'], config['emb_size'], config['lstm_dims'])
-        self.tok_encoder = BOWEncoder(config['n_words'], config['emb_size'], config['n_hidden'])
-        self.desc_encoder = SeqEncoder(config['n_words'], config['emb_size'], config['lstm_dims'])
-        self.fuse = nn.Linear(config['emb_size'] + 4 * config['lstm_dims'], config['n_hidden'])
-
-        # create a model path to store model info
-        if not os.path.exists(config['workdir'] + 'models/'):
-            os.makedirs(config['workdir'] + 'models/')
+        self.negatives = config['negatives']
+        self.parts = parts
+
+        pad_aware = config['pad_aware']
+        if 'code' in parts:
+            self.name_encoder = SeqEncoder(config['n_words'], config['emb_size'], config['lstm_dims'],
+                                           pad_aware=pad_aware)
+            self.api_encoder = SeqEncoder(config['n_words'], config['emb_size'], config['lstm_dims'],
+                                          pad_aware=pad_aware)
+            self.tok_encoder = BOWEncoder(config['n_words'], config['emb_size'], config['n_hidden'])
+        if 'desc' in parts:
+            self.desc_encoder = SeqEncoder(config['n_words'], config['emb_size'], config['lstm_dims'],
+                                           pad_aware=pad_aware)
+        if 'code' in parts:  # built in this order so that a full model keeps the same initialization
+            self.fuse = nn.Linear(config['emb_size'] + 4 * config['lstm_dims'], config['n_hidden'])
 
     def code_encoding(self, name, api, tokens):
         name_repr = self.name_encoder(name)
@@ -78,9 +112,11 @@ class JointEmbeder(nn.Module):
         desc_repr = self.desc_encoder(desc)
         return desc_repr
 
-    def forward(self, name, apiseq, tokens, desc_good, desc_bad):  # self.data_params['methname_len']
+    def forward(self, name, apiseq, tokens, desc_good, desc_bad=None):  # self.data_params['methname_len']
         code_repr = self.code_encoding(name, apiseq, tokens)
         desc_good_repr = self.desc_encoding(desc_good)
+        if desc_bad is None:
+            return self.in_batch_loss(code_repr, desc_good_repr, desc_good)
         desc_bad_repr = self.desc_encoding(desc_bad)
 
         good_sim = F.cosine_similarity(code_repr, desc_good_repr)
@@ -88,3 +124,20 @@ class JointEmbeder(nn.Module):
 
         loss = (self.margin - good_sim + bad_sim).clamp(min=1e-6).mean()
         return loss
+
+    def in_batch_loss(self, code_repr, desc_repr, descs):
+        """
+        margin loss of every code against the descriptions of the other examples of the batch,
+        averaged over all of them ('batch' negatives) or taken on the most similar one ('hardest').
+        Descriptions identical to the code's own one are not negatives.
+        """
+        sims = F.normalize(code_repr, dim=1).mm(F.normalize(desc_repr, dim=1).t())  # [batch_sz x batch_sz]
+        good_sim = sims.diag().unsqueeze(1)
+        # 1 where the token sequences differ, so 0 on the diagonal
+        negatives = (descs.unsqueeze(1) != descs.unsqueeze(0)).long().max(2)[0].float()
+        losses = (self.margin - good_sim + sims).clamp(min=1e-6) * negatives
+        if self.negatives == 'hardest':
+            loss = losses.max(1)[0]
+        else:
+            loss = losses.sum(1) / negatives.sum(1).clamp(min=1)
+        return loss.mean()
@@ -0,0 +1,83 @@
+"""
+Torch-free description encoder for the search replicas.
+
+The weights of the `desc_encoder` of a JointEmbeder (embedding and bidirectional LSTM) are dumped
+to a `.npz` file; NumpyDescEncoder replays SeqEncoder's forward and max pooling with NumPy only,
+so loading it neither imports torch nor builds the code encoders:
+
+    python codesearcher.py --mode export       # also writes models/<model_name>/epo<reload>_desc.npz
+
+With conf['numpy_desc_encoder'], the search, serve and batch_search modes encode the queries with it.
+"""
+import numpy as np
+
+from vocab import PAD_token
+
+NPZ_SUFFIX = '_desc.npz'
+
+
+def export_desc_encoder(model, fout):
+    """dump the desc_encoder weights of a JointEmbeder to `fout` (.npz)"""
+    encoder = model.desc_encoder
+    weights = {name: param.detach().cpu().numpy() for name, param in encoder.lstm.named_parameters()}
+    np.savez(fout, embedding=encoder.embedding.weight.detach().cpu().numpy(),
+             pad_aware=np.array(encoder.pad_aware), **weights)
+
+
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def lstm_direction(x, w_ih, w_hh, bias, active, reverse=False):
+    """
+    one direction of a single layer LSTM (gates in torch order: input, forget, cell, output).
+    x: [batch x seq x emb], active: [batch x seq] steps to run, the other ones keep the state
+    return: [batch x seq x hidden] outputs
+    """
+    batch_size, seq_len, _ = x.shape
+    hidden_size = w_hh.shape[1]
+    inputs = x.dot(w_ih.T) + bias  # every input projection at once
+    h = np.zeros((batch_size, hidden_size), dtype=x.dtype)
+    c = np.zeros((batch_size, hidden_size), dtype=x.dtype)
+    outputs = np.zeros((batch_size, seq_len, hidden_size), dtype=x.dtype)
+    for t in (range(seq_len - 1, -1, -1) if reverse else range(seq_len)):
+        gates = inputs[:, t] + h.dot(w_hh.T)
+        i, f, g, o = np.split(gates, 4, axis=1)
+        c_t = sigmoid(f) * c + sigmoid(i) * np.tanh(g)
+        h_t = sigmoid(o) * np.tanh(c_t)
+        step = active[:, t:t + 1]
+        # a packed sequence starts its backward pass at its last real step, from a zero state
+        c = np.where(step, c_t, c)
+        h = np.where(step, h_t, h)
+        outputs[:, t] = h_t
+    return outputs
+
+
+class NumpyDescEncoder:
+    """desc_encoding of an exported desc_encoder, on [batch x desc_len] arrays of word indices"""
+    torch_free = True
+
+    def __init__(self, fname):
+        with np.load(fname) as f:
+            self.embedding = f['embedding']
+            self.pad_aware = bool(f['pad_aware'])
+            self.directions = [(f['weight_ih_l0' + suffix], f['weight_hh_l0' + suffix],
+                                f['bias_ih_l0' + suffix] + f['bias_hh_l0' + suffix]) for suffix in ('', '_reverse')]
+
+    def desc_encoding(self, descs):
+        """return: [batch x 2*lstm_dims] unnormalized desc vectors"""
+        descs = np.asarray(descs)
+        if self.pad_aware:
+            # sequences are padded at the end, an empty sequence still runs one (padding) step
+            lengths = np.maximum(np.count_nonzero(descs != PAD_token, axis=1), 1)
+            # the recurrence stops at the longest sequence of the batch, not at desc_len
+            descs = descs[:, :lengths.max()]
+            active = np.arange(descs.shape[1]) < lengths[:, None]
+        else:
+            active = np.ones(descs.shape, dtype=bool)
+        embedded = self.embedding[descs]
+        outputs = np.concatenate([lstm_direction(embedded, w_ih, w_hh, bias, active, reverse)
+                                  for (w_ih, w_hh, bias), reverse in zip(self.directions, (False, True))], axis=2)
+        # the padded steps never win the max pooling
+        outputs[~active] = -np.inf
+        return np.tanh(outputs.max(1))
@@ -0,0 +1,111 @@
+"""
+Multi-process code representation for CPU hosts.
+
+The `use_*` rows are split in contiguous ranges, one per process. Every process builds its own
+`JointEmbeder` with a capped number of intra-op threads and writes its range to a shard vector
+store, then the shards are concatenated in order into the single `use_codevecs` store.
+"""
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+
+from data import batch_loader, load_dataset
+from models import JointEmbeder
+from utils import normalize
+from vecstore import META_SUFFIX, append_vecs, create_store, open_store, read_header, read_meta, write_meta, \
+    write_store
+
+logger = logging.getLogger(__name__)
+
+
+def shard_ranges(n_rows, n_shards):
+    """split [0, n_rows) in n_shards contiguous ranges of (almost) the same size"""
+    bounds = np.linspace(0, n_rows, n_shards + 1).astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def encode_shard(conf, state_dict, start, stop, fname, norm, epoch=0):
+    """
+    encode rows [start, stop) of the use dataset into the vector store `fname`, resuming if it exists
+    and was written by the same model and epoch for the same rows
+    """
+    torch.set_num_threads(conf['repr_threads_per_process'])
+    meta = {'model_name': conf['model_name'], 'epoch': epoch, 'start': start, 'stop': stop}
+    done = 0
+    if os.path.exists(fname) and read_meta(fname) == meta and read_header(fname).normalized == norm:
+        done = read_header(fname).count
+    else:
+        create_store(fname, conf['n_hidden'], conf['codevecs_dtype'], norm)
+        write_meta(fname, meta)
+    if start + done >= stop:
+        return stop - start
+
+    model = JointEmbeder(conf, parts=('code',))
+    model.load_state_dict({key: value for key, value in state_dict.items() if not key.startswith('desc_encoder.')})
+    model.eval()
+    # rows are read from disk, loading the whole files in every process would multiply the memory
+    use_set = load_dataset(conf, 'use')
+    batches = [np.arange(i, min(i + conf['repr_batch_size'], stop))
+               for i in range(start + done, stop, conf['repr_batch_size'])]
+    data_loader = batch_loader(use_set, batches)
+    with torch.no_grad():
+        for names, apis, toks in data_loader:
+            reprs = model.code_encoding(names, apis, toks).data.numpy()
+            done = append_vecs(fname, normalize(reprs) if norm else reprs)
+    logger.info("Shard {} done: rows [{}, {})".format(fname, start, stop))
+    return done
+
+
+def _encode_shard(args):
+    return encode_shard(*args)
+
+
+def merge_shards(shards, fout, norm, dtype, block_size=65536):
+    """concatenate the shard stores, in order, into `fout`"""
+    tmp = fout + '.merging'
+    header = create_store(tmp, read_header(shards[0]).dim, dtype, norm)
+    for shard in shards:
+        vecs = open_store(shard)
+        for i in range(0, len(vecs), block_size):
+            header.count = append_vecs(tmp, vecs[i:i + block_size])
+        del vecs
+    os.replace(tmp, fout)
+    for shard in shards:
+        os.remove(shard)
+        os.remove(shard + META_SUFFIX)
+    return header.count
+
+
+def repr_code_parallel(conf, model, norm=True, epoch=0):
+    """
+    encode the use dataset with conf['repr_processes'] processes, return the memory mapped vectors.
+    epoch: of the weights of `model`, the shards of another epoch are not resumed
+    """
+    n_procs = conf['repr_processes']
+    fout = conf['workdir'] + conf['use_codevecs']
+    use_set = load_dataset(conf, 'use')  # builds the arrays once, before the workers read them
+    n_rows = len(use_set)
+    state_dict = {k: v.cpu() for k, v in model.state_dict().items()}
+
+    shards = ['{}.shard{}of{}'.format(fout, i, n_procs) for i in range(n_procs)]
+    tasks = [(conf, state_dict, start, stop, shard, norm, epoch)
+             for (start, stop), shard in zip(shard_ranges(n_rows, n_procs), shards)]
+    logger.info("Encoding {} rows with {} processes x {} threads".format(n_rows, n_procs,
+                                                                      conf['repr_threads_per_process']))
+    # spawn: forking a process that already ran torch ops can deadlock in the intra-op thread pool
+    with multiprocessing.get_context('spawn').Pool(n_procs) as pool:
+        counts = pool.map(_encode_shard, tasks)
+    assert sum(counts) == n_rows, 'Encoded {} rows out of {}'.format(sum(counts), n_rows)
+
+    if n_rows == 0:
+        for shard in shards:
+            os.remove(shard)
+            os.remove(shard + META_SUFFIX)
+        write_store(np.empty((0, conf['n_hidden']), dtype=np.float32), fout, conf['codevecs_dtype'], norm)
+    else:
+        merge_shards(shards, fout, norm, conf['codevecs_dtype'])
+    logger.info("Code vectors written to {}".format(fout))
+    return open_store(fout)
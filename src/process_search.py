@@ -0,0 +1,242 @@
+"""
+Exact search split over worker processes, for the machines where the threads of BlockedSearchEngine
+contend on the GIL (top-k selection, result building).
+
+Every worker memory maps the vector store: the vectors live once in the page cache whatever the number
+of processes. Worker i owns the fixed slice i of the rows, a query batch is sent to all of them and
+the per-slice top K are merged by the coordinator.
+"""
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from search_engine import merge_top_k, top_k
+from vecstore import is_vecstore, load_vecs
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # optional, only used to bound the BLAS threads
+    threadpool_limits = None
+
+logger = logging.getLogger(__name__)
+
+
+def split_rows(n_rows, n_parts):
+    """n_parts contiguous (start, stop) slices of n_rows rows, of sizes differing by at most one"""
+    bounds = np.linspace(0, n_rows, n_parts + 1).astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def search_slice(vecs, queries, start, stop, n_results, deleted, block_size):
+    """
+    best rows of vecs[start:stop] for every query, scored block by block.
+    deleted: sorted ids of the tombstoned rows of the slice, never returned
+    return: (scores, ids) both [n_queries x <= n_results], sorted by decreasing score
+    """
+    scores, ids = [], []
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        block = vecs[block_start:block_stop]
+        if block.dtype != np.float32:
+            block = block.astype(np.float32)
+        sims = np.dot(queries, block.T)  # [n_queries x block]
+        lo, hi = np.searchsorted(deleted, (block_start, block_stop))
+        if hi > lo:
+            sims[:, deleted[lo:hi] - block_start] = -np.inf
+        best = top_k(sims, n_results)
+        scores.append(np.take_along_axis(sims, best, axis=-1))
+        ids.append(best + block_start)
+    if not scores:
+        empty = np.empty((queries.shape[0], 0))
+        return empty.astype(np.float32), empty.astype(np.int64)
+    return merge_top_k(np.concatenate(scores, axis=1), np.concatenate(ids, axis=1), n_results)
+
+
+def worker(conn, fname, block_size, blas_threads):
+    """
+    serve the (request id, generation, start, stop, queries, n_results, tombstones key, deleted) requests
+    of `conn` until None, answering (request id, result or exception).
+    A compaction replaces the store file and starts a new generation: the mapping of the previous
+    one is kept for the searches still running on the replaced engine.
+    The deleted ids of the slice are only sent when they changed (deleted is None otherwise), the
+    worker keeps the last ones it received.
+    """
+    if threadpool_limits is not None and blas_threads:
+        threadpool_limits(limits=blas_threads)
+    stores = {0: load_vecs(fname)}
+    tombstones_key, tombstones = None, None
+    while True:
+        request = conn.recv()
+        if request is None:
+            return
+        request_id, generation, start, stop, queries, n_results, key, deleted = request
+        if deleted is not None:
+            tombstones_key, tombstones = key, deleted
+        try:
+            if key != tombstones_key:
+                raise RuntimeError("Tombstones {} were never sent to the worker".format(key))
+            deleted = tombstones
+            vecs = stores.get(generation)
+            if vecs is None or len(vecs) < stop:  # new generation, or rows appended since the mapping
+                vecs = stores[generation] = load_vecs(fname)
+                for old in sorted(stores)[:-2]:
+                    del stores[old]
+            conn.send((request_id, search_slice(vecs, queries, start, stop, n_results, deleted, block_size)))
+        except Exception as e:
+            conn.send((request_id, e))
+
+
+class WorkerPool:
+    """
+    the worker processes of a vector store and their pipes, shared by the engines of successive compactions.
+    The requests are tagged with an id: the searches of several threads are queued to the workers
+    together, a reader thread per pipe hands every answer to the search waiting for it.
+    """
+
+    def __init__(self, fname, n_processes, block_size, blas_threads=1):
+        # spawned: the workers inherit neither the model nor the threads of the parent
+        context = multiprocessing.get_context('spawn')
+        self.conns, self.processes, self.readers = [], [], []
+        self.send_locks = []  # one per pipe, a request is never interleaved with another one
+        self.pending = {}  # (request id, worker) -> Future of its answer
+        self.request_ids = itertools.count()
+        self.deleted_versions = itertools.count()  # bumped by every update of the tombstones of an engine
+        self.sent_tombstones = [None] * n_processes  # (version, start, stop) of the deleted ids last sent
+        for i in range(n_processes):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=worker, args=(child_conn, fname, block_size, blas_threads), daemon=True)
+            process.start()
+            child_conn.close()
+            reader = threading.Thread(target=self.read, args=(i, conn), daemon=True)
+            reader.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+            self.readers.append(reader)
+            self.send_locks.append(threading.Lock())
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.processes)
+
+    def read(self, i, conn):
+        while True:
+            try:
+                request_id, result = conn.recv()
+            except (EOFError, OSError):  # the worker exited
+                break
+            self.pending.pop((request_id, i)).set_result(result)
+        for key in [key for key in list(self.pending) if key[1] == i]:
+            self.pending.pop(key).set_exception(RuntimeError("Search worker {} exited".format(i)))
+
+    def search(self, generation, slices, queries, n_results, deleted, deleted_version):
+        """
+        per-slice (scores, ids) of the workers.
+        deleted: sorted ids of all the tombstoned rows, only sent to a worker when they or its slice changed
+        """
+        request_id = next(self.request_ids)
+        futures = []
+        for i, (conn, lock, (start, stop)) in enumerate(zip(self.conns, self.send_locks, slices)):
+            future = self.pending[request_id, i] = Future()
+            futures.append(future)
+            key = (deleted_version, start, stop)
+            with lock:
+                ids = None
+                if self.sent_tombstones[i] != key:
+                    lo, hi = np.searchsorted(deleted, (start, stop))
+                    ids = deleted[lo:hi]
+                    self.sent_tombstones[i] = key
+                conn.send((request_id, generation, start, stop, queries, n_results, key, ids))
+        results = [future.result() for future in futures]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def close(self):
+        for conn, lock in zip(self.conns, self.send_locks):
+            with lock:
+                conn.send(None)
+        for process, reader, conn in zip(self.processes, self.readers, self.conns):
+            process.join()
+            reader.join()
+            conn.close()
+
+
+class ProcessSearchEngine:
+    """
+    Same results as BlockedSearchEngine, with the rows split over the `n_processes` workers of a WorkerPool.
+    fname: vector store of `vecs` (memory mapped by the workers), block_size: rows scored at once by a worker
+    """
+
+    def __init__(self, vecs, fname, n_processes, block_size, blas_threads=1, pool=None, metrics=None):
+        assert is_vecstore(fname), 'Process search needs a vector store, convert {} with vecstore.py'.format(fname)
+        self.vecs = vecs
+        self.fname = fname
+        self.block_size = block_size
+        self.pool = pool or WorkerPool(fname, n_processes, block_size, blas_threads)
+        self.generation = self.pool.generation
+        self.slices = split_rows(len(vecs), len(self.pool))
+        self.deleted = None  # optional boolean mask of the tombstoned rows, never returned
+        self.metrics = metrics  # optional Metrics, times the fan-out and the final merge
+        logger.debug("Process search engine: {} rows, {} processes".format(len(vecs), len(self.pool)))
+
+    def __len__(self):
+        return len(self.vecs)
+
+    @property
+    def deleted(self):
+        return self._deleted
+
+    @deleted.setter
+    def deleted(self, deleted):
+        # the ids sent to the workers are computed once per update of the tombstones, not per query:
+        # the mask must be assigned again after being modified in place
+        self._deleted = deleted
+        self.deleted_ids = np.flatnonzero(deleted) if deleted is not None else np.empty(0, dtype=np.int64)
+        self.deleted_version = next(self.pool.deleted_versions)
+
+    def append(self, vecs):
+        """search `vecs`, the current rows followed by new ones, from now on. The last worker owns the new rows"""
+        self.vecs = vecs
+        self.slices = self.slices[:-1] + [(self.slices[-1][0], len(vecs))]
+
+    def compact(self, vecs, keep):
+        """new engine over `vecs` (the store file was replaced), on the same workers, with balanced slices"""
+        # searches still running on this engine go on with the mapping of the previous generation
+        self.pool.generation += 1
+        return ProcessSearchEngine(vecs, self.fname, len(self.pool), self.block_size, pool=self.pool,
+                                   metrics=self.metrics)
+
+    def search_batch(self, queries, n_results):
+        """
+        queries: [n_queries x dim] normalized float32 matrix
+        return: (scores, ids) both [n_queries x n_results], sorted by decreasing score
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.metrics is not None:
+            tic = time.perf_counter()
+        results = self.pool.search(self.generation, self.slices, queries, n_results, self.deleted_ids,
+                                   self.deleted_version)
+        if self.metrics is not None:
+            toc = time.perf_counter()
+            self.metrics.observe('fanout', toc - tic)
+        scores = np.concatenate([s for s, _ in results], axis=1)
+        ids = np.concatenate([i for _, i in results], axis=1)
+        result = merge_top_k(scores, ids, n_results)
+        if self.metrics is not None:
+            self.metrics.observe('merge', time.perf_counter() - toc)
+        return result
+
+    def search(self, query, n_results):
+        """query: normalized vector of size dim, return: (scores, ids) of the best n_results rows"""
+        scores, ids = self.search_batch(query.reshape(1, -1), n_results)
+        return scores[0], ids[0]
+
+    def close(self):
+        self.pool.close()
+
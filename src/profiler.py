@@ -0,0 +1,214 @@
+"""
+Per-iteration profile of the train, repr_code and eval loops: time waiting for the data loader and
+time of every stage of the loop body, throughput and memory.
+
+    profiler = PipelineProfiler('train', trace_file, log_every=100)
+    for batch in profiler.iterate(data_loader):    # times the data loader wait
+        with profiler.stage('forward'):
+            ...
+        profiler.step(len(batch[0]))               # ends the iteration
+    profiler.close()                               # summary of the whole run
+
+A summary (mean ms per stage, samples/sec, RSS) is logged every `log_every` iterations. The
+iterations and the summaries are streamed to a JSON lines trace. The torch autograd profiler can
+record a window of iterations, exported as a chrome://tracing file.
+"""
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+from metrics import NULL_TIMER
+
+logger = logging.getLogger(__name__)
+
+
+def rss_bytes():
+    """resident set size of the process, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_bytes():
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def cuda_in_use():
+    torch = sys.modules.get('torch')  # never imported for the profiler
+    return torch is not None and torch.cuda.is_available()
+
+
+class StageTimer:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.sync:  # the CUDA kernels run asynchronously, charge them to their stage
+            sys.modules['torch'].cuda.synchronize()
+        record = self.profiler.current
+        record[self.name] = record.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+class PipelineProfiler:
+    """
+    name: loop name, in the logs and the trace
+    trace_file: JSON lines trace, one line per iteration and one per periodic summary ({"summary": ...}),
+        flushed with every summary so that a killed run keeps its trace. Only the iterations since the
+        last summary are kept in memory.
+    torch_window: (first iteration, number of iterations) recorded by the torch autograd profiler,
+        exported next to the trace as <trace_file>.torch.json
+    """
+
+    def __init__(self, name, trace_file=None, log_every=100, torch_window=None):
+        self.name = name
+        self.trace_file = trace_file
+        self.log_every = log_every
+        self.torch_window = torch_window
+        self.sync = cuda_in_use()
+        self.window = []  # records of the iterations since the last summary
+        self.stage_totals = {}  # seconds of every stage over the whole run
+        self.seconds = 0.0
+        self.current = {}
+        self.itr = 0
+        self.samples = 0
+        self.start = None
+        self._itr_start = None
+        self._torch_profile = None
+        self._trace = open(trace_file, 'w') if trace_file is not None else None
+
+    def iterate(self, iterable):
+        """yield the items of `iterable`, the time spent in its `next` is the 'data' stage"""
+        iterator = iter(iterable)
+        while True:
+            tic = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if self.start is None:
+                self.start = tic
+            self._itr_start = tic
+            self.current = {'data': time.perf_counter() - tic}
+            self.start_torch_profile()
+            yield item
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def step(self, n_samples):
+        """end of the iteration started by `iterate`, which processed `n_samples` examples"""
+        if self.sync:
+            sys.modules['torch'].cuda.synchronize()
+        record = self.current
+        record['total'] = time.perf_counter() - self._itr_start
+        record['samples'] = n_samples
+        for stage, seconds in record.items():
+            if stage not in ('total', 'samples'):
+                self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + seconds
+        self.seconds += record['total']
+        self.itr += 1
+        self.samples += n_samples
+        if self._trace is not None:
+            record['itr'] = self.itr
+            self._trace.write(json.dumps(record) + '\n')
+        self.stop_torch_profile()
+        if self.log_every:
+            self.window.append(record)
+            if self.itr % self.log_every == 0:
+                self.log_summary(*self.aggregate(self.window))
+                self.window = []
+
+    def start_torch_profile(self):
+        if self.torch_window and self.itr == self.torch_window[0] and self._torch_profile is None:
+            import torch
+
+            self._torch_profile = torch.autograd.profiler.profile(use_cuda=self.sync)
+            self._torch_profile.__enter__()
+
+    def stop_torch_profile(self, force=False):
+        if self._torch_profile is not None and (force or self.itr >= sum(self.torch_window)):
+            self._torch_profile.__exit__(None, None, None)
+            fname = (self.trace_file or self.name) + '.torch.json'
+            self._torch_profile.export_chrome_trace(fname)
+            logger.info("[PROFILE] {}: torch profile of iterations {}-{} written to {}".format(
+                self.name, self.torch_window[0], self.itr - 1, fname))
+            self._torch_profile = None
+            self.torch_window = None
+
+    @staticmethod
+    def aggregate(iterations):
+        """(seconds per stage, total seconds, samples, number) of a list of iteration records"""
+        stages = {}
+        for record in iterations:
+            for stage, seconds in record.items():
+                if stage not in ('total', 'samples', 'itr'):
+                    stages[stage] = stages.get(stage, 0.0) + seconds
+        return (stages, sum(record['total'] for record in iterations),
+                sum(record['samples'] for record in iterations), len(iterations))
+
+    def summarize(self, stages, seconds, samples, n_iterations):
+        """mean seconds and share of the total of every stage, samples/sec and memory"""
+        seconds = seconds or float('nan')
+        summary = {'iterations': self.itr, 'window': n_iterations,
+                   'samples_per_sec': samples / seconds,
+                   'stages': {stage: {'mean_ms': total / n_iterations * 1000, 'share': total / seconds}
+                              for stage, total in stages.items()},
+                   'rss_bytes': rss_bytes(), 'peak_rss_bytes': peak_rss_bytes()}
+        if self.sync:
+            summary['peak_cuda_bytes'] = sys.modules['torch'].cuda.max_memory_allocated()
+        return summary
+
+    def log_summary(self, stages, seconds, samples, n_iterations):
+        summary = self.summarize(stages, seconds, samples, n_iterations)
+        logger.info('[PROFILE] {} itr:{} {:.1f} samples/s {} rss={:.0f}MB'.format(
+            self.name, self.itr, summary['samples_per_sec'],
+            ' '.join('{}={:.1f}ms({:.0%})'.format(stage, values['mean_ms'], values['share'])
+                     for stage, values in summary['stages'].items()),
+            (summary['rss_bytes'] or 0) / 2 ** 20))
+        if self._trace is not None:
+            self._trace.write(json.dumps({'summary': summary}) + '\n')
+            self._trace.flush()
+        return summary
+
+    def close(self):
+        """stop a pending torch profile and write the summary of the whole run"""
+        self.stop_torch_profile(force=True)
+        if self.itr:
+            self.log_summary(self.stage_totals, self.seconds, self.samples, self.itr)
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+            logger.info("[PROFILE] {}: trace written to {}".format(self.name, self.trace_file))
+
+
+class NullProfiler:
+    """the same interface doing nothing, used when profiling is off"""
+
+    def iterate(self, iterable):
+        return iterable
+
+    def stage(self, name):
+        return NULL_TIMER
+
+    def step(self, n_samples):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
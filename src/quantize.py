@@ -0,0 +1,254 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from ivf import recall_at_k
+from search_engine import top_k
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_SUFFIX = '.{}.npz'  # formatted with the quantizer name
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension uint8 quantization: x ~= vmin + scale * code.
+    The inner product with a query q is then q.vmin + (q * scale).code
+    """
+    name = 'sq8'
+
+    def __init__(self, vmin=None, scale=None):
+        self.vmin = vmin
+        self.scale = scale
+
+    def train(self, vecs, block_size=65536):
+        vmin = np.full(vecs.shape[1], np.inf, dtype=np.float32)
+        vmax = np.full(vecs.shape[1], -np.inf, dtype=np.float32)
+        for i in range(0, len(vecs), block_size):
+            block = np.asarray(vecs[i:i + block_size], dtype=np.float32)
+            vmin = np.minimum(vmin, block.min(axis=0))
+            vmax = np.maximum(vmax, block.max(axis=0))
+        self.vmin = vmin
+        self.scale = np.maximum(vmax - vmin, 1e-12) / 255.0
+        return self
+
+    def encode(self, vecs):
+        codes = np.rint((np.asarray(vecs, dtype=np.float32) - self.vmin) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.vmin + self.scale * codes.astype(np.float32)
+
+    def scorer(self, query):
+        """function computing the approximate inner products of `query` with a block of codes"""
+        offset = np.dot(query, self.vmin)
+        weights = (query * self.scale).astype(np.float32)
+        return lambda codes: np.dot(codes.astype(np.float32), weights) + offset
+
+    def state(self):
+        return {'vmin': self.vmin, 'scale': self.scale}
+
+
+def kmeans_l2(vecs, n_clusters, n_iter, rng):
+    """plain (euclidean) k-means used to train the product quantizer codebooks"""
+    centroids = vecs[rng.choice(len(vecs), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        # argmin ||x - c||^2 = argmax x.c - ||c||^2 / 2
+        assign = np.argmax(np.dot(vecs, centroids.T) - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids, dtype=np.float64)
+        np.add.at(sums, assign, vecs)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        empty = np.flatnonzero(~nonempty)
+        centroids[empty] = vecs[rng.choice(len(vecs), len(empty), replace=False)]
+    return centroids.astype(np.float32)
+
+
+class ProductQuantizer:
+    """
+    Split the vectors in `m` sub-vectors and encode each with the id (uint8) of its closest
+    codebook centroid. Inner products are computed with a [m x k] lookup table per query, k = 256
+    centroids per codebook (fewer when trained on less than 256 vectors).
+    """
+    name = 'pq'
+
+    def __init__(self, m=None, codebooks=None):
+        self.m = m
+        self.codebooks = codebooks  # [m x k x dsub]
+
+    def train(self, vecs, n_iter=20, sample_size=65536, seed=42):
+        assert vecs.shape[1] % self.m == 0, 'dim {} is not a multiple of m={}'.format(vecs.shape[1], self.m)
+        rng = np.random.RandomState(seed)
+        sample = np.asarray(vecs[np.sort(rng.choice(len(vecs), min(len(vecs), sample_size), replace=False))],
+                            dtype=np.float32)
+        n_clusters = min(256, len(sample))
+        subs = np.split(sample, self.m, axis=1)
+        # no untrained (zero) centroid that encode could pick
+        self.codebooks = np.zeros((self.m, n_clusters, sample.shape[1] // self.m), dtype=np.float32)
+        for i, sub in enumerate(subs):
+            logger.debug("Training PQ codebook {}/{}".format(i + 1, self.m))
+            self.codebooks[i] = kmeans_l2(sub, n_clusters, n_iter, rng)
+        return self
+
+    def encode(self, vecs):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        codes = np.empty((len(vecs), self.m), dtype=np.uint8)
+        for i, (sub, codebook) in enumerate(zip(np.split(vecs, self.m, axis=1), self.codebooks)):
+            codes[:, i] = np.argmax(np.dot(sub, codebook.T) - 0.5 * (codebook ** 2).sum(axis=1), axis=1)
+        return codes
+
+    def decode(self, codes):
+        return np.concatenate([self.codebooks[i][codes[:, i]] for i in range(self.m)], axis=1)
+
+    def scorer(self, query):
+        lut = np.einsum('mkd,md->mk', self.codebooks, query.reshape(self.m, -1).astype(np.float32))  # [m x k]
+        columns = np.arange(self.m)
+        return lambda codes: lut[columns, codes].sum(axis=1)
+
+    def state(self):
+        return {'m': np.array(self.m), 'codebooks': self.codebooks}
+
+
+QUANTIZERS = {q.name: q for q in (ScalarQuantizer, ProductQuantizer)}
+
+
+def encode_all(quantizer, vecs, block_size=65536):
+    return np.concatenate([quantizer.encode(vecs[i:i + block_size]) for i in range(0, len(vecs), block_size)])
+
+
+def save_quantized(fname, quantizer, codes):
+    np.savez(fname, kind=np.array(quantizer.name), codes=codes, **quantizer.state())
+
+
+def load_quantized(fname):
+    with np.load(fname) as f:
+        kind = str(f['kind'])
+        if kind == ScalarQuantizer.name:
+            quantizer = ScalarQuantizer(f['vmin'], f['scale'])
+        else:
+            quantizer = ProductQuantizer(int(f['m']), f['codebooks'])
+        return quantizer, f['codes']
+
+
+class QuantizedSearchEngine:
+    """
+    Approximate scan over the compressed codes, then exact re-ranking of the best `rerank`
+    candidates with the full precision vectors (memory mapped, only the candidate rows are read).
+    """
+
+    def __init__(self, vecs, quantizer, codes, rerank, block_size=65536):
+        self.vecs = vecs
+        self.quantizer = quantizer
+        self.codes = codes
+        self.rerank = rerank
+        self.block_size = block_size
+        self.deleted = None  # optional boolean mask of the tombstoned rows, never returned
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, vecs):
+        """search `vecs`, the current rows followed by new ones, from now on"""
+        self.vecs = vecs
+        self.codes = np.concatenate([self.codes, self.quantizer.encode(vecs[len(self.codes):])])
+
+    def compact(self, vecs, keep):
+        """new engine over `vecs`, the rows of the current ones selected by the `keep` mask"""
+        return QuantizedSearchEngine(vecs, self.quantizer, self.codes[keep], self.rerank, self.block_size)
+
+    def scan(self, query, n_candidates):
+        score = self.quantizer.scorer(query)
+        scores, ids = [], []
+        for start in range(0, len(self.codes), self.block_size):
+            sims = score(self.codes[start:start + self.block_size])
+            if self.deleted is not None:
+                sims[self.deleted[start:start + len(sims)]] = -np.inf
+            best = top_k(sims, n_candidates)
+            scores.append(sims[best])
+            ids.append(best + start)
+        scores, ids = np.concatenate(scores), np.concatenate(ids)
+        return ids[top_k(scores, n_candidates)]
+
+    def search(self, query, n_results):
+        candidates = np.sort(self.scan(query, max(self.rerank, n_results)))
+        sims = np.dot(np.asarray(self.vecs[candidates], dtype=np.float32), query)
+        if self.deleted is not None:
+            sims[self.deleted[candidates]] = -np.inf
+        best = top_k(sims, n_results)
+        return sims[best], candidates[best]
+
+    def search_batch(self, queries, n_results):
+        results = [self.search(q, n_results) for q in queries]
+        return np.stack([s for s, _ in results]), np.stack([i for _, i in results])
+
+
+def report_recall(vecs, quantizer, codes, queries, n_results, reranks, exact_engine):
+    """recall@K and latency of the quantized search for every re-ranking depth, against the exact search"""
+    exact_ids = [exact_engine.search(q, n_results)[1] for q in queries]
+    report = []
+    for rerank in reranks:
+        engine = QuantizedSearchEngine(vecs, quantizer, codes, rerank)
+        start = time.perf_counter()
+        approx_ids = [engine.search(q, n_results)[1] for q in queries]
+        elapsed = (time.perf_counter() - start) / len(queries)
+        report.append({'rerank': rerank, 'recall': recall_at_k(exact_ids, approx_ids),
+                       'latency_ms': elapsed * 1000})
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Quantize the code vectors and evaluate the quantized search")
+    parser.add_argument("mode", choices=["build", "recall"])
+    parser.add_argument("--type", choices=list(QUANTIZERS), default=None,
+                        help="quantizer (default: conf['search_index'])")
+    parser.add_argument("--m", type=int, default=None, help="PQ sub-vectors (default: conf['pq_m'])")
+    parser.add_argument("--queries", default=None,
+                        help="vector store of query (desc) vectors, default: sampled code vectors")
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=10, help="recall@K")
+    parser.add_argument("--rerank", type=int, nargs='+', default=[10, 50, 100, 500, 1000])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from configs import get_config
+    from vecstore import load_vecs
+    from search_engine import BlockedSearchEngine, limit_blas_threads
+    from utils import normalize
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    args = parse_args()
+    conf = get_config()
+    kind = args.type or conf['search_index']
+    assert kind in QUANTIZERS, 'Unknown quantizer {}'.format(kind)
+    vecs_file = conf['workdir'] + conf['use_codevecs']
+    quantized_file = vecs_file + QUANTIZED_SUFFIX.format(kind)
+    vecs = load_vecs(vecs_file)
+
+    if args.mode == 'build':
+        if kind == ProductQuantizer.name:
+            _quantizer = ProductQuantizer(args.m or conf['pq_m']).train(vecs)
+        else:
+            _quantizer = ScalarQuantizer().train(vecs)
+        _codes = encode_all(_quantizer, vecs)
+        save_quantized(quantized_file, _quantizer, _codes)
+        logger.info("{} codes saved to {} ({:.1f}x smaller than float32)".format(
+            kind, quantized_file, vecs.shape[1] * 4.0 / _codes.shape[1]))
+
+    elif args.mode == 'recall':
+        _quantizer, _codes = load_quantized(quantized_file)
+        if args.queries:
+            queries = normalize(np.asarray(load_vecs(args.queries), dtype=np.float32))[:args.n_queries]
+        else:
+            rows = np.random.RandomState(0).choice(len(vecs), min(len(vecs), args.n_queries), replace=False)
+            queries = np.asarray(vecs[np.sort(rows)], dtype=np.float32)
+        limit_blas_threads(conf['blas_threads'])
+        exact = BlockedSearchEngine(vecs, conf['chunk_size'], conf['search_workers'])
+        print("{} queries={} K={} compression={:.1f}x".format(kind, len(queries), args.k,
+                                                              vecs.shape[1] * 4.0 / _codes.shape[1]))
+        for line in report_recall(vecs, _quantizer, _codes, queries, args.k, args.rerank, exact):
+            print("rerank={rerank:6d} recall@K={recall:.4f} latency={latency_ms:.3f}ms".format(**line))
+        exact.close()
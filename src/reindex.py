@@ -0,0 +1,143 @@
+"""
+Incremental code representation.
+
+Every row of the use dataset is keyed by the SHA-1 of its encoder input (method name, API sequence
+and tokens). The digests of the current vector store are saved next to it with the size and mtime of
+the store they describe; a re-index only encodes the digests that are not in the previous store (or
+encoded by another model epoch), copies the vectors of the others and encodes every duplicated snippet
+once. A store rewritten since (repr_code, online inserts) is encoded again from scratch.
+"""
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+from data import batch_loader
+from utils import gVar, normalize
+from vecstore import append_vecs, create_store, open_store, read_header
+
+logger = logging.getLogger(__name__)
+
+HASHES_SUFFIX = '.hashes.npz'
+
+
+def row_digests(use_set, batch_size=1000):
+    """SHA-1 of the encoder input of every row, as a [n_rows] 'S20' array"""
+    batches = [np.arange(i, min(i + batch_size, len(use_set))) for i in range(0, len(use_set), batch_size)]
+    data_loader = batch_loader(use_set, batches, num_workers=2)
+    digests = []
+    for names, apis, toks in data_loader:
+        rows = np.concatenate([names.numpy(), apis.numpy(), toks.numpy()], axis=1).astype(np.int64)
+        digests.extend(hashlib.sha1(row.tobytes()).digest() for row in rows)
+    return np.array(digests, dtype='S20')
+
+
+def store_fingerprint(fname):
+    """(size, mtime in ns) of a vector store, changed by any rewrite or append"""
+    stat = os.stat(fname)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_hashes(fname, store):
+    """
+    (digests, model epoch) of the rows of the vector store `store`, None if unknown
+    or if the store was written after the digests
+    """
+    if not os.path.exists(fname) or not os.path.exists(store):
+        return None, None
+    with np.load(fname) as f:
+        if 'store' not in f or not np.array_equal(f['store'], store_fingerprint(store)):
+            return None, None
+        epoch = int(f['epoch'])
+        return f['digests'], (epoch if epoch >= 0 else None)
+
+
+def drop_hashes(store):
+    """forget the digests of `store`, called before it is rewritten by a full repr_code"""
+    if os.path.exists(store + HASHES_SUFFIX):
+        os.remove(store + HASHES_SUFFIX)
+
+
+def lookup(old_digests, digests):
+    """row of every digest in old_digests, -1 when missing"""
+    rows = np.full(len(digests), -1, dtype=np.int64)
+    if old_digests is None or len(old_digests) == 0:
+        return rows
+    sorter = np.argsort(old_digests)
+    pos = np.minimum(np.searchsorted(old_digests, digests, sorter=sorter), len(old_digests) - 1)
+    found = old_digests[sorter[pos]] == digests
+    rows[found] = sorter[pos[found]]
+    return rows
+
+
+def encode_rows(model, use_set, rows, fname, conf, norm):
+    """encode the given rows of the use dataset into a new vector store"""
+    create_store(fname, conf['n_hidden'], conf['codevecs_dtype'], norm)
+    batches = [np.asarray(rows[i:i + conf['repr_batch_size']]) for i in range(0, len(rows), conf['repr_batch_size'])]
+    data_loader = batch_loader(use_set, batches, num_workers=2, pin_memory=True)
+    with torch.no_grad():
+        for itr, (names, apis, toks) in enumerate(data_loader, start=1):
+            names, apis, toks = gVar(names), gVar(apis), gVar(toks)
+            reprs = model.eval().code_encoding(names, apis, toks).data.cpu().numpy()
+            append_vecs(fname, normalize(reprs) if norm else reprs)
+            if itr % 100 == 0:
+                logger.info('itr:{}/{}'.format(itr, len(rows) // conf['repr_batch_size']))
+    return open_store(fname)
+
+
+def reindex(searcher, model, norm=True, block_size=65536):
+    """
+    re-encode only the new or changed rows of the use dataset and rewrite `use_codevecs`.
+    return: the memory mapped vectors
+    """
+    conf = searcher.model_params
+    fout = searcher.path + conf['use_codevecs']
+    hashes_file = fout + HASHES_SUFFIX
+    use_set = searcher.load_use_set()
+
+    logger.info("Hashing {} rows".format(len(use_set)))
+    digests = row_digests(use_set, conf['repr_batch_size'])
+    unique, first_rows, inverse = np.unique(digests, return_index=True, return_inverse=True)
+
+    old_digests, old_epoch = load_hashes(hashes_file, fout)
+    old_vecs = None
+    if old_digests is not None:
+        header = read_header(fout)
+        if old_epoch is None or old_epoch != searcher.model_epoch or header.normalized != norm \
+                or header.count != len(old_digests):
+            logger.info("Previous vectors come from another model or setting, re-encoding everything")
+            old_digests = None
+        else:
+            old_vecs = open_store(fout)
+    old_rows = lookup(old_digests, unique)  # per unique digest
+
+    missing = np.flatnonzero(old_rows < 0)
+    logger.info("{} rows, {} unique, {} to encode".format(len(digests), len(unique), len(missing)))
+    new_vecs = encode_rows(model, use_set, first_rows[missing].tolist(), fout + '.new', conf, norm)
+    new_rows = np.full(len(unique), -1, dtype=np.int64)
+    new_rows[missing] = np.arange(len(missing))
+
+    # assemble the store in row order, reused vectors from the old store, the others from the new ones
+    tmp = fout + '.reindex'
+    create_store(tmp, conf['n_hidden'], conf['codevecs_dtype'], norm)
+    for start in range(0, len(digests), block_size):
+        ids = inverse[start:start + block_size]
+        block = np.empty((len(ids), conf['n_hidden']), dtype=np.float32)
+        reused = old_rows[ids] >= 0
+        if reused.any():
+            block[reused] = old_vecs[old_rows[ids[reused]]]
+        block[~reused] = new_vecs[new_rows[ids[~reused]]]
+        append_vecs(tmp, block)
+    del old_vecs, new_vecs
+
+    # without digests the next re-index encodes everything, so a crash in between stays safe
+    if os.path.exists(hashes_file):
+        os.remove(hashes_file)
+    os.replace(tmp, fout)
+    os.remove(fout + '.new')
+    np.savez(hashes_file, digests=digests, store=store_fingerprint(fout),
+             epoch=np.array(-1 if searcher.model_epoch is None else searcher.model_epoch))
+    logger.info("Code vectors written to {}".format(fout))
+    return open_store(fout)
@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # optional, only used to bound the BLAS threads
+    threadpool_limits = None
+
+logger = logging.getLogger(__name__)
+
+
+def limit_blas_threads(n_threads):
+    """
+    cap the BLAS threads of the whole process, once by the search roles (search, serve, batch_search):
+    search workers x BLAS threads stay bounded by the number of cores. BLAS libraries only have a
+    process wide setting, the training and encoding roles keep all their threads.
+    """
+    if threadpool_limits is not None and n_threads:
+        threadpool_limits(limits=n_threads)
+
+
+def top_k(sims, k):
+    """indices of the k largest values of every row of `sims`, sorted by decreasing value"""
+    k = min(k, sims.shape[-1])
+    if k < sims.shape[-1]:
+        part = np.argpartition(-sims, kth=k - 1, axis=-1)[..., :k]
+    else:
+        part = np.broadcast_to(np.arange(sims.shape[-1]), sims.shape).copy()
+    order = np.argsort(-np.take_along_axis(sims, part, axis=-1), axis=-1, kind='stable')
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def merge_top_k(scores, ids, k):
+    """merge per-block candidates ([n_queries x n_candidates]) into the global top k"""
+    best = top_k(scores, k)
+    return np.take_along_axis(scores, best, axis=-1), np.take_along_axis(ids, best, axis=-1)
+
+
+class BlockedSearchEngine:
+    """
+    Exhaustive inner product search over one contiguous matrix (float32, or float16 converted
+    block by block), possibly memory mapped. The rows are split in blocks of `block_size`, every
+    block is scored with a single matrix product on a persistent thread pool and only (score, row id)
+    pairs of the per-block top K are merged. The BLAS threads are capped by the caller, see
+    `limit_blas_threads`.
+    """
+
+    def __init__(self, vecs, block_size, n_workers=None, pool=None, metrics=None):
+        self.vecs = vecs if vecs.dtype in (np.float32, np.float16) and vecs.flags['C_CONTIGUOUS'] \
+            else np.ascontiguousarray(vecs, dtype=np.float32)
+        self.block_size = block_size
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.deleted = None  # optional boolean mask of the tombstoned rows, never returned
+        self.metrics = metrics  # optional Metrics, times the scoring and the selection of every block
+        self.blocks = self.split_blocks(len(self.vecs))
+        self.pool = pool or ThreadPoolExecutor(max_workers=self.n_workers)
+        logger.debug("Search engine: {} rows, {} blocks, {} workers".format(len(self.vecs), len(self.blocks),
+                                                                          self.n_workers))
+
+    def __len__(self):
+        return len(self.vecs)
+
+    def split_blocks(self, n_rows):
+        return [(i, min(i + self.block_size, n_rows)) for i in range(0, n_rows, self.block_size)]
+
+    def append(self, vecs):
+        """search `vecs`, the current rows followed by new ones, from now on"""
+        self.vecs = vecs
+        self.blocks = self.split_blocks(len(vecs))
+
+    def compact(self, vecs, keep):
+        """new engine over `vecs`, the rows of the current ones selected by the `keep` mask"""
+        # the pool is shared, searches still running on this engine can go on
+        return BlockedSearchEngine(vecs, self.block_size, self.n_workers, pool=self.pool, metrics=self.metrics)
+
+    def _search_block(self, queries, start, stop, n_results):
+        if self.metrics is not None:
+            tic = time.perf_counter()
+        block = self.vecs[start:stop]
+        if block.dtype != np.float32:
+            block = block.astype(np.float32)
+        sims = np.dot(queries, block.T)  # [n_queries x block]
+        if self.deleted is not None:
+            deleted = self.deleted[start:stop]
+            if deleted.any():
+                sims[:, deleted] = -np.inf
+        if self.metrics is not None:
+            toc = time.perf_counter()
+            self.metrics.observe('score_block', toc - tic)
+        best = top_k(sims, n_results)
+        result = np.take_along_axis(sims, best, axis=-1), best + start
+        if self.metrics is not None:
+            self.metrics.observe('select_block', time.perf_counter() - toc)
+        return result
+
+    def search_batch(self, queries, n_results):
+        """
+        queries: [n_queries x dim] normalized float32 matrix
+        return: (scores, ids) both [n_queries x n_results], sorted by decreasing score
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if not self.blocks:
+            empty = np.empty((queries.shape[0], 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+        futures = [self.pool.submit(self._search_block, queries, start, stop, n_results)
+                   for start, stop in self.blocks]
+        results = [f.result() for f in futures]
+        if self.metrics is not None:
+            tic = time.perf_counter()
+        scores = np.concatenate([s for s, _ in results], axis=1)
+        ids = np.concatenate([i for _, i in results], axis=1)
+        result = merge_top_k(scores, ids, n_results)
+        if self.metrics is not None:
+            self.metrics.observe('merge', time.perf_counter() - tic)
+        return result
+
+    def search(self, query, n_results):
+        """query: normalized vector of size dim, return: (scores, ids) of the best n_results rows"""
+        scores, ids = self.search_batch(query.reshape(1, -1), n_results)
+        return scores[0], ids[0]
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,235 @@
+"""
+Long running search server (HTTP/JSON on localhost or on a Unix socket).
+
+    POST /search  {"query": "read file lines", "n_results": 10}
+    GET  /stats
+    GET  /metrics  stage latencies and counters in the Prometheus text format (conf['metrics'])
+
+Concurrent queries are collected in micro-batches, encoded with one padded `desc_encoding`
+call and scored with one matrix-matrix product. The query vectors and the ranked results go through
+the LRU caches of CodeSearcher: a repeated query is answered without being batched.
+"""
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def format_results(codebase, scores, ids):
+    """JSON results of the rows `ids`, with their snippets"""
+    return [{'id': int(i), 'score': float(s), 'snippet': snippet}
+            for i, s, snippet in zip(ids, scores, codebase.get(ids))]
+
+
+class MicroBatcher:
+    """
+    Queue of pending queries. A batch is closed when it reaches `max_batch_size` or when
+    `batch_window` seconds have passed since its first query.
+    """
+
+    def __init__(self, searcher, model, batch_window, max_batch_size):
+        self.searcher = searcher
+        self.model = model
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue()
+        # the model and the search engine run out of the event loop, one batch at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.n_queries = 0
+        self.n_cached = 0
+        self.n_batches = 0
+        self.max_queue_depth = 0
+
+    async def search(self, desc, n_results):
+        # the ranked results are shared with CodeSearcher.search, a cached query never waits for a batch
+        self.searcher.check_caches()
+        _, codebase, version = self.searcher.snapshot()
+        result = self.searcher.result_cache.get((tuple(desc.tolist()), n_results, None, version))
+        if result is not None:
+            self.n_cached += 1
+            self.searcher.record_cache_metrics()
+            return await asyncio.get_event_loop().run_in_executor(None, format_results, codebase, *result)
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((desc, n_results, future))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def run_batch(self, batch):
+        searcher, metrics = self.searcher, self.searcher.metrics
+        n_results = max(n for _, n, _ in batch)
+        search_engine, codebase, version = searcher.snapshot()
+        # only the queries missing from the vector cache are encoded
+        tokens = [tuple(desc.tolist()) for desc, _, _ in batch]
+        desc_reprs = [searcher.desc_cache.get(key) for key in tokens]
+        misses = [i for i, desc_repr in enumerate(desc_reprs) if desc_repr is None]
+        if misses:
+            with metrics.time('encode_batch'):
+                encoded = searcher.encode_descs(self.model, [batch[i][0] for i in misses])
+            for i, desc_repr in zip(misses, encoded):
+                desc_reprs[i] = desc_repr
+                searcher.desc_cache.put(tokens[i], desc_repr)
+        with metrics.time('search_batch'):
+            scores, ids = search_engine.search_batch(np.stack(desc_reprs), n_results)
+        results = []
+        with metrics.time('snippets_batch'):
+            for key, (_, n, _), row_scores, row_ids in zip(tokens, batch, scores, ids):
+                # approximate engines pad short result lists with -1, deleted rows score -inf
+                keep = (row_ids[:n] >= 0) & np.isfinite(row_scores[:n])
+                result = row_scores[:n][keep], row_ids[:n][keep]
+                searcher.result_cache.put((key, n, None, version), result)
+                results.append(format_results(codebase, *result))
+        metrics.inc('queries', len(batch))
+        metrics.inc('results', sum(len(result) for result in results))
+        metrics.set('index_size', len(search_engine))
+        searcher.record_cache_metrics()
+        return results
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.next_batch()
+            self.n_batches += 1
+            self.n_queries += len(batch)
+            logger.debug("Batch of {} queries, {} waiting".format(len(batch), self.queue.qsize()))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                logger.exception("Batch failed")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, _, future), result in zip(batch, results):
+                    if not future.done():  # cancelled when the client went away
+                        future.set_result(result)
+
+    def stats(self):
+        return {'queue_depth': self.queue.qsize(), 'max_queue_depth': self.max_queue_depth,
+                'queries': self.n_queries, 'cached_queries': self.n_cached, 'batches': self.n_batches,
+                'mean_batch_size': self.n_queries / float(self.n_batches) if self.n_batches else 0.0}
+
+
+class SearchServer:
+    def __init__(self, searcher, model, conf):
+        self.searcher = searcher
+        self.conf = conf
+        self.batcher = MicroBatcher(searcher, model, conf['batch_window_ms'] / 1000.0, conf['max_batch_size'])
+
+    async def handle_search(self, body):
+        request = json.loads(body.decode('utf-8'))
+        if not isinstance(request, dict) or not isinstance(request.get('query'), str):
+            return 400, {'error': 'expected {"query": <string>, "n_results": <int>}'}
+        n_results = request.get('n_results', 10)
+        if not isinstance(n_results, int) or isinstance(n_results, bool) or n_results < 1:
+            return 400, {'error': 'n_results must be a positive integer'}
+        with self.searcher.metrics.time('tokenize'):
+            desc = self.searcher.tokenizer([request['query']])[0]  # unknown words are UNK_token
+        return 200, {'results': await self.batcher.search(desc, n_results)}
+
+    async def route(self, method, path, body):
+        if path == '/search':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            return await self.handle_search(body)
+        if path == '/stats':
+            return 200, {'batcher': self.batcher.stats(), 'caches': self.searcher.cache_stats(),
+                         'index_size': len(self.searcher.search_engine)}
+        if path == '/metrics':
+            if not self.searcher.metrics.enabled:
+                return 404, {'error': 'metrics are disabled, set conf["metrics"]'}
+            return 200, self.searcher.metrics.render()
+        return 404, {'error': 'unknown path {}'.format(path)}
+
+    @staticmethod
+    async def respond(writer, status, response):
+        if isinstance(response, str):  # /metrics
+            payload, content_type = response.encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            payload, content_type = json.dumps(response).encode('utf-8'), 'application/json'
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+            status, REASONS[status], content_type, len(payload)).encode('latin-1') + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError("negative Content-Length")
+                except ValueError as e:
+                    # the end of the request is unknown, the connection cannot be reused
+                    await self.respond(writer, 400, {'error': 'malformed request: {}'.format(e)})
+                    break
+                body = await reader.readexactly(length)
+                try:
+                    status, response = await self.route(method, path, body)
+                except (ValueError, TypeError) as e:
+                    status, response = 400, {'error': str(e)}
+                except Exception as e:
+                    status, response = 500, {'error': str(e)}
+                await self.respond(writer, status, response)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        asyncio.ensure_future(self.batcher.run())
+        if self.conf['server_socket']:
+            server = await asyncio.start_unix_server(self.handle, path=self.conf['server_socket'])
+            logger.info("Serving on {}".format(self.conf['server_socket']))
+        else:
+            server = await asyncio.start_server(self.handle, self.conf['server_host'], self.conf['server_port'])
+            logger.info("Serving on http://{}:{}".format(self.conf['server_host'], self.conf['server_port']))
+        return server
+
+
+def serve(searcher, model, conf):
+    """load the index once and serve queries until interrupted"""
+    searcher.load_codevecs()
+    searcher.load_codebase()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(SearchServer(searcher, model, conf).start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        searcher.flush_index()
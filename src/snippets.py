@@ -0,0 +1,111 @@
+import logging
+import mmap
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 64mb
+BUF_SIZE = 1 << 26
+INDEX_SUFFIX = '.offsets.npy'
+
+
+def build_offsets(fname):
+    """
+    byte offset of the start of every line of `fname`, plus the file size as the last entry.
+    Lines are split on b'\\n' only, so row i of the store is line i of the raw code file.
+    """
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    pos = 0
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(BUF_SIZE)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append((newlines + pos + 1).astype(np.uint64))
+            pos += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != pos:  # last line without a trailing newline
+        offsets = np.append(offsets, np.uint64(pos))
+    return offsets
+
+
+def load_offsets(fname):
+    """load the offsets index saved next to `fname`, (re)building it when missing or stale"""
+    index = fname + INDEX_SUFFIX
+    size = os.path.getsize(fname)
+    if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(fname):
+        offsets = np.load(index, mmap_mode='r')
+        if len(offsets) and offsets[-1] == size:
+            return offsets
+    logger.info("Indexing snippets of {}".format(fname))
+    offsets = build_offsets(fname)
+    np.save(index, offsets)
+    return offsets
+
+
+class SnippetStore:
+    """
+    Access to the lines of the raw code file by row number.
+    The file is memory mapped and only the requested rows are decoded; new rows are appended.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._remap(load_offsets(fname))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if not -len(self) <= row < len(self):
+            raise IndexError("snippet {} out of range".format(row))
+        row %= len(self)
+        # TODO: there are some weird encoding issues so just ignore them for now
+        return self._mmap[int(self.offsets[row]):int(self.offsets[row + 1])].decode('utf-8', errors='ignore')
+
+    def get(self, rows):
+        return [self[row] for row in rows]
+
+    def append(self, lines):
+        """append snippets (one line each) to the raw code file, return their row ids"""
+        start = len(self)
+        end = int(self.offsets[-1])
+        prefix = b''
+        if end and self._mmap[end - 1:end] != b'\n':  # the last line had no trailing newline
+            prefix = b'\n'
+        rows = [(line.replace('\n', ' ') + '\n').encode('utf-8') for line in lines]
+        with open(self.fname, 'ab') as f:
+            f.write(prefix + b''.join(rows))
+        ends = end + len(prefix) + np.cumsum([len(row) for row in rows], dtype=np.uint64)
+        offsets = np.concatenate([self.offsets[:-1], np.array([end + len(prefix)], dtype=np.uint64), ends])
+        np.save(self.fname + INDEX_SUFFIX, offsets)
+        self._remap(offsets)
+        return np.arange(start, len(self))
+
+    def truncate(self, n_rows):
+        """drop every row after the first `n_rows`, undoes a failed `append`"""
+        offsets = self.offsets[:n_rows + 1].copy()
+        with open(self.fname, 'r+b') as f:
+            f.truncate(int(offsets[-1]))
+        np.save(self.fname + INDEX_SUFFIX, offsets)
+        self._remap(offsets)
+
+    def copy_rows(self, rows, fout, mode='wb'):
+        """write the given rows, in order, to a raw code file"""
+        with open(fout, mode) as f:
+            for row in rows:
+                data = self._mmap[int(self.offsets[row]):int(self.offsets[row + 1])]
+                f.write(data if data.endswith(b'\n') else data + b'\n')
+
+    def _remap(self, offsets):
+        # searches running on the previous map keep their reference to it
+        with open(self.fname, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b''
+        self.offsets = offsets
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
@@ -2,7 +2,8 @@ import math
 import time
 
 import numpy as np
-import torch
+
+from vocab import UNK_token
 
 
 def cos_np(data1, data2):
@@ -26,6 +27,32 @@ def dot_np(data1, data2):
     return np.dot(data1, np.transpose(data2))
 
 
+def pool_ranks(descs, codes, tile=4096):
+    """
+    rank (1-based) of codes[i] among all the codes for descs[i], with normalized [n x dim] matrices.
+    The [n x n] similarities are computed by [tile x tile] blocks.
+    """
+    true_sims = np.einsum('ij,ij->i', descs, codes)
+    ranks = np.ones(len(descs), dtype=np.int64)
+    for i in range(0, len(descs), tile):
+        for j in range(0, len(codes), tile):
+            sims = dot_np(descs[i:i + tile], codes[j:j + tile])
+            # the own code of a desc never counts against it, whatever the rounding of the two products
+            own = np.arange(max(i, j), min(i + tile, j + tile, len(descs), len(codes)))
+            sims[own - i, own - j] = -np.inf
+            ranks[i:i + tile] += (sims > true_sims[i:i + tile, None]).sum(axis=1)
+    return ranks
+
+
+def ranking_metrics(ranks, K):
+    """mean ACC@K, MRR, MAP and nDCG@K when a single result is relevant and found at `ranks`"""
+    found = ranks <= K
+    reciprocal = np.where(found, 1.0 / ranks, 0.0)
+    # with one relevant result the average precision is the reciprocal rank and the ideal DCG is 1
+    ndcg = np.where(found, 1.0 / np.log2(ranks + 1), 0.0)
+    return found.mean(), reciprocal.mean(), reciprocal.mean(), ndcg.mean()
+
+
 #######################################################################
 
 def asMinutes(s):
@@ -46,17 +73,37 @@ def timeSince(since, percent):
 
 def sent2indexes(sentence, vocab):
     '''sentence: a string
-       return: a numpy array of word indices
+       return: a numpy array of word indices, UNK_token for the unknown words
     '''
-    return np.array([vocab[word] for word in sentence.strip().split(' ')])
+    return np.array([vocab.get(word, UNK_token) for word in sentence.strip().split()], dtype=np.int64)
+
+
+def pad_batch(seqs, maxlen=None, pad=0, fixed=False):
+    """
+    pad (and truncate to maxlen) a list of index sequences into a [n x len] int64 matrix,
+    len is the longest sequence, or maxlen when fixed
+    """
+    length = maxlen if fixed else max(len(seq) for seq in seqs)
+    if maxlen is not None:
+        length = min(length, maxlen)
+    batch = np.full((len(seqs), length), pad, dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        seq = seq[:length]
+        batch[i, :len(seq)] = seq
+    return batch
 
 
 ########################################################################
 
-use_cuda = torch.cuda.is_available()
+use_cuda = None  # set by the first gVar: torch is only imported by the roles that run a model
 
 
 def gVar(data):
+    global use_cuda
+    import torch
+
+    if use_cuda is None:
+        use_cuda = torch.cuda.is_available()
     tensor = data
     if isinstance(data, np.ndarray):
         tensor = torch.from_numpy(data)
@@ -0,0 +1,168 @@
+"""
+Raw vector store: a fixed size header followed by the row-major vectors.
+
+    magic (8 bytes) | dim (uint32) | dtype (uint8) | normalized (uint8) | count (uint64) | padding up to HEADER_SIZE
+
+The body can be memory mapped as is, so opening a store costs the same for any number of
+vectors and processes that map the same file share the page cache.
+"""
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'CSVECS01'
+HEADER_FORMAT = '<8sIBBxxQ'
+HEADER_SIZE = 64
+META_SUFFIX = '.meta.json'
+COUNT_OFFSET = struct.calcsize('<8sIBBxx')
+
+DTYPES = {0: np.dtype('float32'), 1: np.dtype('float16')}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+
+class VecHeader:
+    def __init__(self, dim, dtype, count=0, normalized=True):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.normalized = normalized
+        if self.dtype not in DTYPE_CODES:
+            raise ValueError("Unsupported vector dtype {}".format(self.dtype))
+
+    @property
+    def row_size(self):
+        return self.dim * self.dtype.itemsize
+
+    def pack(self):
+        header = struct.pack(HEADER_FORMAT, MAGIC, self.dim, DTYPE_CODES[self.dtype], int(self.normalized),
+                             self.count)
+        return header.ljust(HEADER_SIZE, b'\0')
+
+    @classmethod
+    def unpack(cls, raw):
+        magic, dim, dtype, normalized, count = struct.unpack(HEADER_FORMAT, raw[:struct.calcsize(HEADER_FORMAT)])
+        if magic != MAGIC:
+            raise ValueError("Not a vector store (magic={!r})".format(magic))
+        return cls(dim, DTYPES[dtype], count, bool(normalized))
+
+
+def is_vecstore(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(fname):
+    with open(fname, 'rb') as f:
+        return VecHeader.unpack(f.read(HEADER_SIZE))
+
+
+def create_store(fname, dim, dtype='float32', normalized=True):
+    """create an empty store, overwriting `fname`"""
+    header = VecHeader(dim, dtype, 0, normalized)
+    with open(fname, 'wb') as f:
+        f.write(header.pack())
+    return header
+
+
+def append_vecs(fname, vecs):
+    """
+    append rows to an existing store.
+    The body is written and flushed before the count in the header is updated, so a crash
+    leaves at most some unreferenced bytes at the end of the file.
+    """
+    with open(fname, 'r+b') as f:
+        header = VecHeader.unpack(f.read(HEADER_SIZE))
+        if vecs.ndim != 2 or vecs.shape[1] != header.dim:
+            raise ValueError("Expected vectors of dim {}, got shape {}".format(header.dim, vecs.shape))
+        f.seek(HEADER_SIZE + header.count * header.row_size)
+        f.write(np.ascontiguousarray(vecs, dtype=header.dtype).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+        header.count += vecs.shape[0]
+        f.seek(COUNT_OFFSET)
+        f.write(struct.pack('<Q', header.count))
+        f.flush()
+        os.fsync(f.fileno())
+    return header.count
+
+
+def write_meta(fname, meta):
+    """record what a store being written holds (model, epoch, rows), checked before resuming it"""
+    with open(fname + META_SUFFIX, 'w') as f:
+        json.dump(meta, f)
+
+
+def read_meta(fname):
+    """the meta of `fname`, None when missing or unreadable"""
+    try:
+        with open(fname + META_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def truncate_store(fname, count):
+    """drop every row after the first `count`"""
+    with open(fname, 'r+b') as f:
+        header = VecHeader.unpack(f.read(HEADER_SIZE))
+        header.count = min(count, header.count)
+        f.seek(COUNT_OFFSET)
+        f.write(struct.pack('<Q', header.count))
+        f.truncate(HEADER_SIZE + header.count * header.row_size)
+
+
+def write_store(vecs, fname, dtype='float32', normalized=True):
+    """write a whole [n x dim] matrix to a new store"""
+    header = VecHeader(vecs.shape[1], dtype, vecs.shape[0], normalized)
+    tmp = fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.pack())
+        for i in range(0, vecs.shape[0], 65536):  # avoid a full size copy when converting the dtype
+            f.write(np.ascontiguousarray(vecs[i:i + 65536], dtype=header.dtype).tobytes())
+    os.replace(tmp, fname)
+    return header
+
+
+def open_store(fname, mode='r'):
+    """memory map the vectors of a store as a [count x dim] array"""
+    header = read_header(fname)
+    if header.count == 0:
+        return np.empty((0, header.dim), dtype=header.dtype)
+    return np.memmap(fname, dtype=header.dtype, mode=mode, offset=HEADER_SIZE, shape=(header.count, header.dim))
+
+
+def load_vecs(fin):
+    """
+    read vectors (2D numpy array) from a vector store, memory mapped,
+    or from a legacy hdf5 file, fully loaded in memory
+    """
+    if is_vecstore(fin):
+        return open_store(fin)
+    import tables
+
+    with tables.open_file(fin) as h5f:
+        return np.array(h5f.root.vecs)
+
+
+def save_vecs(vecs, fout, dtype='float32', normalized=True):
+    """write vectors (2D numpy array) to a vector store"""
+    header = write_store(vecs, fout, dtype, normalized)
+    print('done: {} vectors'.format(header.count))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Convert code vectors to a memory mapped vector store")
+    parser.add_argument("input", help="vectors file, HDF5 (`save_vecs` legacy format) or vector store")
+    parser.add_argument("output", help="vector store to write")
+    parser.add_argument("--dtype", choices=[str(d) for d in DTYPE_CODES], default='float32')
+    parser.add_argument("--not-normalized", action="store_true", help="the input vectors are not normalized")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    header = write_store(load_vecs(args.input), args.output, args.dtype, normalized=not args.not_normalized)
+    print("{} vectors of dim {} written to {}".format(header.count, header.dim, args.output))
@@ -0,0 +1,141 @@
+"""
+Compact vocabularies and the batched query tokenizer.
+
+A pickled vocabulary (dict word -> id) is converted once to two flat arrays saved next to it,
+the sorted utf-8 words (fixed width bytes) and their ids. Both are memory mapped: loading costs
+the same for any vocabulary size and a batch of words is looked up with one binary search.
+
+    python vocab.py <workdir>vocab.desc.pkl [...]
+"""
+import argparse
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+PAD_token = 0
+SOS_token = 1
+EOS_token = 2
+UNK_token = 3
+
+WORDS_SUFFIX = '.words.npy'
+IDS_SUFFIX = '.ids.npy'
+
+
+def load_dict(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+class Vocab:
+    """word -> id lookups on the sorted word table, unknown words map to UNK_token"""
+
+    def __init__(self, words, ids):
+        self.words = words
+        self.ids = ids
+
+    @classmethod
+    def from_dict(cls, vocab):
+        words = np.array([word.encode('utf-8') for word in vocab])
+        ids = np.array(list(vocab.values()), dtype=np.int32)
+        order = np.argsort(words)
+        return cls(words[order], ids[order])
+
+    @classmethod
+    def load(cls, fname):
+        return cls(np.load(fname + WORDS_SUFFIX, mmap_mode='r'), np.load(fname + IDS_SUFFIX, mmap_mode='r'))
+
+    def save(self, fname):
+        np.save(fname + WORDS_SUFFIX, self.words)
+        np.save(fname + IDS_SUFFIX, self.ids)
+
+    def __len__(self):
+        return len(self.words)
+
+    def lookup(self, words):
+        """ids of a list of words, UNK_token for the unknown ones"""
+        ids = np.full(len(words), UNK_token, dtype=np.int64)
+        if not len(words) or not len(self.words):
+            return ids
+        encoded = np.array([word.encode('utf-8') for word in words])
+        # longer words would be truncated to the table width by the search, they are unknown anyway
+        fits = np.char.str_len(encoded) <= self.words.dtype.itemsize
+        candidates = encoded[fits].astype(self.words.dtype)
+        pos = np.minimum(np.searchsorted(self.words, candidates), len(self.words) - 1)
+        found = self.words[pos] == candidates
+        ids[np.flatnonzero(fits)[found]] = self.ids[pos[found]]
+        return ids
+
+    def get(self, word, default=None):
+        word_id = int(self.lookup([word])[0])
+        return default if word_id == UNK_token and word not in self else word_id
+
+    def __contains__(self, word):
+        if not len(self.words):
+            return False
+        encoded = word.encode('utf-8')
+        pos = min(int(np.searchsorted(self.words, encoded)), len(self.words) - 1)
+        return bool(self.words[pos] == encoded)
+
+    def __getitem__(self, word):
+        word_id = self.get(word)
+        if word_id is None:
+            raise KeyError(word)
+        return word_id
+
+
+def load_vocab(fname):
+    """compact vocabulary of the pickled `fname`, converted next to it when missing or stale"""
+    if os.path.exists(fname + WORDS_SUFFIX) and os.path.exists(fname + IDS_SUFFIX) and (
+            not os.path.exists(fname) or os.path.getmtime(fname + IDS_SUFFIX) >= os.path.getmtime(fname)):
+        return Vocab.load(fname)
+    logger.info("Converting the vocabulary {}".format(fname))
+    Vocab.from_dict(load_dict(fname)).save(fname)
+    return Vocab.load(fname)
+
+
+class Tokenizer:
+    """
+    Queries -> [n x maxlen] int64 matrix of word ids, truncated and padded with PAD_token, in one call.
+    The ids of the frequent words are memoized, the others are looked up together.
+    """
+
+    def __init__(self, vocab, maxlen, cache_size=10000):
+        self.vocab = vocab
+        self.maxlen = maxlen
+        self.cache = LRUCache(cache_size)
+
+    def __call__(self, queries):
+        sentences = [query.strip().split()[:self.maxlen] for query in queries]
+        ids = {}
+        for sentence in sentences:
+            for word in sentence:
+                if word not in ids:
+                    ids[word] = self.cache.get(word)
+        missing = [word for word, word_id in ids.items() if word_id is None]
+        for word, word_id in zip(missing, self.vocab.lookup(missing).tolist()):
+            ids[word] = word_id
+            self.cache.put(word, word_id)
+
+        batch = np.full((len(sentences), self.maxlen), PAD_token, dtype=np.int64)
+        for i, sentence in enumerate(sentences):
+            batch[i, :len(sentence)] = [ids[word] for word in sentence]
+        return batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Convert pickled vocabularies to the compact format")
+    parser.add_argument("vocabs", nargs='+', help="pickled vocabulary files")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    for _fname in parse_args().vocabs:
+        _vocab = Vocab.from_dict(load_dict(_fname))
+        _vocab.save(_fname)
+        print("{} words written to {}{{{},{}}}".format(len(_vocab), _fname, WORDS_SUFFIX, IDS_SUFFIX))